@@ -0,0 +1,214 @@
+"""
+Description:
+    Persistent cache of the Stanford CoreNLP annotations used in the preprocessing of the lexicalization,
+    REG and end-to-end data. Annotations are saved in a sqlite database keyed by the annotated text and the
+    request properties (annotators included), so templates and referring expressions are never sent twice to
+    the parser, neither in re-runs nor across tasks. When the database outgrows its size limit, the least
+    recently used annotations are evicted.
+
+    Annotation backends (Annotator) return annotations in the json format of the CoreNLP server:
+        corenlp: CachedCoreNLP, which only starts the CoreNLP server when an annotation is not in the cache
+        replay: ReplayAnnotator, which only answers from the cache and never starts the server. A missing
+            annotation raises AnnotationMissing, which aborts the preprocessing instead of being taken as a
+            parsing error
+        simple: SimpleAnnotator, an in-process tokenizer and sentence splitter (annotators tokenize and ssplit)
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# Path to the annotation cache
+CACHE_PATH = os.path.abspath(os.path.join('.cache', 'corenlp.db'))
+# Maximum size of the cached annotations in bytes
+CACHE_SIZE = 1024 ** 3
+# Number of writes between two commits of the cache
+COMMIT_EVERY = 1000
+# Default annotation backend: corenlp, replay or simple
+ANNOTATOR = 'corenlp'
+
+
+class AnnotationCache:
+    def __init__(self, path=CACHE_PATH, max_size=CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+        cache_dir = os.path.dirname(path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        # the cache may be shared by the threads which send concurrent requests to the server
+        self.lock = threading.RLock()
+        # processes sharing the cache wait for each other's writes
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS annotation '
+                        '(key TEXT PRIMARY KEY, value TEXT, size INTEGER, accessed REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS annotation_accessed ON annotation (accessed)')
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM annotation').fetchone()[0]
+        self.writes = 0
+        self.hits, self.misses = 0, 0
+
+
+    def key(self, text, properties):
+        request = json.dumps([text, properties], sort_keys=True)
+        return hashlib.sha1(request.encode('utf-8')).hexdigest()
+
+
+    def get(self, text, properties):
+        with self.lock:
+            key = self.key(text, properties)
+            row = self.db.execute('SELECT value FROM annotation WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.db.execute('UPDATE annotation SET accessed = ? WHERE key = ?', (time.time(), key))
+            self.commit()
+            return row[0]
+
+
+    def set(self, text, properties, value):
+        with self.lock:
+            key = self.key(text, properties)
+            size = len(key) + len(value.encode('utf-8'))
+            old = self.db.execute('SELECT size FROM annotation WHERE key = ?', (key,)).fetchone()
+            if old is not None:
+                self.size -= old[0]
+
+            self.db.execute('INSERT OR REPLACE INTO annotation VALUES (?, ?, ?, ?)', (key, value, size, time.time()))
+            self.size += size
+            if self.size > self.max_size:
+                self.evict()
+            self.commit()
+
+
+    def evict(self):
+        # remove the least recently used annotations until the cache takes 90% of its limit
+        limit = 0.9 * self.max_size
+        rows = self.db.execute('SELECT key, size FROM annotation ORDER BY accessed').fetchall()
+        removed = []
+        for key, size in rows:
+            if self.size <= limit:
+                break
+            removed.append((key,))
+            self.size -= size
+        self.db.executemany('DELETE FROM annotation WHERE key = ?', removed)
+
+
+    def commit(self, force=False):
+        self.writes += 1
+        if force or self.writes % COMMIT_EVERY == 0:
+            self.db.commit()
+
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.commit(force=True)
+                self.db.close()
+                self.db = None
+
+
+class AnnotationMissing(KeyError):
+    pass
+
+
+class Annotator:
+    def annotate(self, text, properties=None):
+        raise NotImplementedError
+
+
+    def close(self):
+        pass
+
+
+class CachedCoreNLP(Annotator):
+    def __init__(self, stanford_path, cache_path=CACHE_PATH, max_size=CACHE_SIZE):
+        self.stanford_path = stanford_path
+        self.cache = AnnotationCache(path=cache_path, max_size=max_size)
+        # the server is only started in case of a cache miss
+        self.corenlp = None
+        self.lock = threading.Lock()
+
+
+    def annotate(self, text, properties=None):
+        out = self.cache.get(text, properties)
+        if out is None:
+            with self.lock:
+                if self.corenlp is None:
+                    # imported here, so the other backends run without the CoreNLP client
+                    from stanfordcorenlp import StanfordCoreNLP
+                    self.corenlp = StanfordCoreNLP(self.stanford_path)
+            out = self.corenlp.annotate(text, properties=properties)
+            # error messages of the server are not cached
+            if out.startswith('{'):
+                self.cache.set(text, properties, out)
+        return out
+
+
+    def close(self):
+        if self.corenlp is not None:
+            self.corenlp.close()
+            self.corenlp = None
+        self.cache.close()
+
+
+class ReplayAnnotator(Annotator):
+    def __init__(self, cache_path=CACHE_PATH):
+        self.cache = AnnotationCache(path=cache_path)
+
+
+    def annotate(self, text, properties=None):
+        out = self.cache.get(text, properties)
+        if out is None:
+            raise AnnotationMissing('Annotation not cached: {0}'.format(text))
+        return out
+
+
+    def close(self):
+        self.cache.close()
+
+
+class SimpleAnnotator(Annotator):
+    # clitics, abbreviations, numbers, words and punctuation, in a Penn Treebank-like fashion
+    TOKEN = re.compile(r"\w+(?=n't\b)|n't\b|'(?:s|re|ve|ll|d|m)\b|(?:[A-Za-z]\.){2,}|\d+(?:[.,]\d+)*|\w+(?:[-']\w+)*|\.\.\.|\S",
+                       re.IGNORECASE)
+    END = ['.', '!', '?']
+
+    def annotate(self, text, properties=None):
+        annotators = properties['annotators'].split(',') if properties else ['tokenize', 'ssplit']
+        for annotator in annotators:
+            if annotator not in ['tokenize', 'ssplit']:
+                raise ValueError('Annotator not supported: {0}'.format(annotator))
+
+        sentences, tokens = [], []
+        for match in self.TOKEN.finditer(text):
+            tokens.append({
+                'index': len(tokens) + 1,
+                'word': match.group(),
+                'originalText': match.group(),
+                'characterOffsetBegin': match.start(),
+                'characterOffsetEnd': match.end()
+            })
+            if 'ssplit' in annotators and match.group() in self.END:
+                sentences.append(tokens)
+                tokens = []
+        if len(tokens) > 0:
+            sentences.append(tokens)
+
+        return json.dumps({ 'sentences': [{ 'index': i, 'tokens': snt } for i, snt in enumerate(sentences)] })
+
+
+def load_annotator(annotator=ANNOTATOR, stanford_path=None, cache_path=CACHE_PATH):
+    if annotator == 'replay':
+        return ReplayAnnotator(cache_path=cache_path)
+    elif annotator == 'simple':
+        return SimpleAnnotator()
+    elif annotator == 'corenlp':
+        return CachedCoreNLP(stanford_path, cache_path=cache_path)
+    raise ValueError('Unknown annotator: {0}'.format(annotator))
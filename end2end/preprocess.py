@@ -10,9 +10,15 @@ Description:
         [1] Path to the folder where WebNLG corpus is available (versions/v1.4/en)
         [2] Path to the folder where the data will be saved (Folder will be created in case it does not exist)
         [3] Path to the stanford parser (which can be downloaded here: https://stanfordnlp.github.io/CoreNLP/)
+        [4] Optional annotation backend: corenlp (default), replay (cached annotations only, no CoreNLP server)
+            or simple (in-process tokenizer)
+
+    ENVIRONMENT:
+        DEEPNLG_WORKERS: optional number of processes parsing the corpus files (1 by default)
 
     EXAMPLE:
         python3 preprocess.py ../versions/v1.4/en end2end stanford_path
+        DEEPNLG_WORKERS=8 python3 preprocess.py ../versions/v1.4/en end2end stanford_path
 """
 
 import sys
@@ -26,16 +32,17 @@ import json
 
 from superpreprocess import Preprocess
 from itertools import permutations
+from annotation import AnnotationMissing, load_annotator
 from random import randint
-from stanfordcorenlp import StanfordCoreNLP
 
 STANFORD_PATH=r'~/stanford/stanford-corenlp-full-2018-02-27'
+ANNOTATOR = 'corenlp'
 
 class End2End(Preprocess):
     def __init__(self, data_path, write_path):
         super().__init__(data_path=data_path, write_path=write_path)
 
-        self.corenlp = StanfordCoreNLP(STANFORD_PATH)
+        self.corenlp = load_annotator(ANNOTATOR, STANFORD_PATH)
         self.traindata, self.vocab = self.load_simple(path=os.path.join(data_path, 'train'))#, augment=True)
         self.devdata, _ = self.load_simple(path=os.path.join(data_path, 'dev'))#, augment=False)
         self.testdata, _ = self.load_simple(path=os.path.join(data_path, 'test'))#, augment=False)
@@ -53,6 +60,8 @@ class End2End(Preprocess):
             for snt in out['sentences']:
                 sentence = list(map(lambda w: w['originalText'], snt['tokens']))
                 tokens.extend(sentence)
+        except AnnotationMissing:
+            raise
         except:
             print('Parsing error...')
 
@@ -60,7 +69,7 @@ class End2End(Preprocess):
 
 
     def load(self, path, augment=True):
-        entryset = parsing.run_parser(path)
+        entryset = parsing.run_cached_parser(path)
 
         data, size = [], 0
         invocab, outvocab = [], []
@@ -130,6 +139,8 @@ class End2End(Preprocess):
                                     'source': src,
                                     'targets': targets })
                                 size += len(targets)
+            except AnnotationMissing:
+                raise
             except:
                 print('Preprocessing error...')
 
@@ -145,7 +156,7 @@ class End2End(Preprocess):
 
 
     def load_simple(self, path):
-        entryset = parsing.run_parser(path)
+        entryset = parsing.run_cached_parser(path)
 
         data, size = [], 0
         invocab, outvocab = [], []
@@ -184,6 +195,8 @@ class End2End(Preprocess):
                     'source': source,
                     'targets': targets })
                 size += len(targets)
+            except AnnotationMissing:
+                raise
             except:
                 print('Preprocessing error...')
 
@@ -210,6 +223,8 @@ if __name__ == '__main__':
     data_path = sys.argv[1]
     write_path = sys.argv[2]
     STANFORD_PATH=sys.argv[3]
+    if len(sys.argv) > 4:
+        ANNOTATOR = sys.argv[4]
     s = End2End(data_path=data_path, write_path=write_path)
     s()
 
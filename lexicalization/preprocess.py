@@ -10,9 +10,14 @@ Description:
         [1] Path to the folder where WebNLG corpus is available (versions/v1.4/en)
         [2] Path to the folder where the data will be saved (Folder will be created in case it does not exist)
         [3] Path to the stanford parser (which can be downloaded here: https://stanfordnlp.github.io/CoreNLP/)
+        [4] Optional annotation backend: corenlp (default) or replay (cached annotations only, no CoreNLP server)
+
+    ENVIRONMENT:
+        DEEPNLG_WORKERS: optional number of processes parsing the corpus files (1 by default)
 
     EXAMPLE:
         python3 preprocess.py ../versions/v1.4/en lexicalization stanford_path
+        DEEPNLG_WORKERS=8 python3 preprocess.py ../versions/v1.4/en lexicalization stanford_path
 """
 
 import sys
@@ -25,12 +30,19 @@ import json
 import load
 import parsing
 import os
+import time
 
+from annotation import AnnotationMissing, load_annotator
 from collections import Counter
-from stanfordcorenlp import StanfordCoreNLP
+from concurrent.futures import ThreadPoolExecutor
 
 # Absolute path to 'stanford-corenlp'
 STANFORD_PATH = os.path.abspath('stanford-corenlp-4.3.2')
+# Annotation backend: corenlp or replay (cached annotations only). The templates are parsed, so the simple
+# backend (tokenizer only) is not supported
+ANNOTATOR = 'corenlp'
+# Number of concurrent requests to the CoreNLP server
+WORKERS = 8
 
 
 class Tree:
@@ -38,18 +50,20 @@ class Tree:
         self.tokens = tokens
         self.lemmas = lemmas
         self.token2lemma = dict(zip(tokens, lemmas))
-        self.nodes, self.edges, self.root = self.parse(tree)
+        self.nodes, self.edges, self.root, self.verb_parents = self.parse(tree)
 
 
     def parse(self, tree):
         tree = tree.replace('\n', '').replace('(ROOT', '')[:-1]
         nodes, edges, root = {}, {}, 1
+        # highest node of the chain of VPs above each nonterminal and preterminal node (see verb_parent)
+        vp_tops, verb_parents = {}, {}
         node_id = 1
         prev_id = 0
         terminalidx = 0
 
         for child in tree.split():
-            closing = list(filter(lambda x: x == ')', child))
+            closing = child.count(')')
             if child[0] == '(':
                 nodes[node_id] = {
                     'id': node_id,
@@ -61,7 +75,11 @@ class Tree:
 
                 if prev_id > 0:
                     edges[prev_id].append(node_id)
-                prev_id = copy.copy(node_id)
+                    if nodes[prev_id]['name'] != 'VP':
+                        vp_tops[node_id] = node_id
+                    elif prev_id in vp_tops:
+                        vp_tops[node_id] = vp_tops[prev_id]
+                prev_id = node_id
             else:
                 terminal = child.replace(')', '')
                 nodes[prev_id]['type'] = 'preterminal'
@@ -79,33 +97,25 @@ class Tree:
                     'idx': terminalidx,
                     'lemma': lemma
                 }
+                if prev_id in vp_tops:
+                    verb_parents[terminalidx] = vp_tops[prev_id]
 
                 terminalidx += 1
                 edges[node_id] = []
                 edges[prev_id].append(node_id)
 
             node_id += 1
-            for i in range(len(closing)):
+            for i in range(closing):
                 prev_id = nodes[prev_id]['parent']
 
-        return nodes, edges, root
+        return nodes, edges, root, verb_parents
 
 
     def verb_parent(self, terminalidx):
-        def search(root):
-            parent = self.nodes[root]['parent']
-            if self.nodes[parent]['name'] == 'VP':
-                return search(parent)
-            return root
-
-        terminal_node = -1
-        for node in self.nodes:
-            type = self.nodes[node]['type']
-            if type == 'terminal':
-                if terminalidx == self.nodes[node]['idx']:
-                    terminal_node = node
-                    break
-        return search(self.nodes[terminal_node]['parent'])
+        # highest VP which dominates the terminal through a chain of VPs, or its preterminal otherwise.
+        # Lookups are computed on the parsed tree (before classify_verbs changes it) and raise a KeyError
+        # for unknown terminals or chains which reach the top of the tree.
+        return self.verb_parents[terminalidx]
 
 
     # TO DO: treat modals would, should, might to, must, etc.
@@ -368,8 +378,14 @@ class Tree:
 
 
 class TemplateExtraction:
-    def __init__(self):
-        self.corenlp = StanfordCoreNLP(STANFORD_PATH)
+    def __init__(self, stanford_path=None, workers=WORKERS, annotator=None):
+        annotator = annotator or ANNOTATOR
+        if annotator == 'simple':
+            raise ValueError('The simple annotator does not parse the templates: use corenlp or replay')
+        self.corenlp = load_annotator(annotator, stanford_path or STANFORD_PATH)
+        self.workers = workers
+        # extracted templates of the current run
+        self.memo = {}
 
 
     def close(self):
@@ -527,48 +543,35 @@ class TemplateExtraction:
             for snt in out['sentences']:
                 sentence = ' '.join(map(lambda w: w['originalText'], snt['tokens']))
                 sentences.append(sentence)
+        except AnnotationMissing:
+            raise
         except:
             print('Parsing error...')
 
         return sentences
 
 
-    def extract(self, template):
-        text = template.replace('@', '')
-        dictionary = []
-
+    def parse(self, sentence):
         props = {'annotators': 'tokenize,ssplit,pos,lemma,parse','pipelineLanguage':'en','outputFormat':'json'}
 
-        delex = []
-        sentences = self.tokenize(text)
-        for sentence in sentences:
-            out = self.corenlp.annotate(sentence, properties=props)
-            out = json.loads(out)
+        out = self.corenlp.annotate(sentence, properties=props)
+        out = json.loads(out)
 
-            snt = out['sentences'][0]
-
-            tree = Tree(tree=snt['parse'], tokens=[], lemmas=[])
-            pos = [token['pos'] for token in snt['tokens']]
-            verb = []
-            for i, p in enumerate(pos):
-                if 'VB' in p:
-                    if len(verb) > 0:
-                        if tree.verb_parent(i) == tree.verb_parent(verb[-1]):
-                            verb.append(i)
-                        else:
-                            tokens = [snt['tokens'][j]['originalText'] for j in verb]
-                            lemmas = [snt['tokens'][j]['lemma'] for j in verb]
-                            pos = [snt['tokens'][j]['pos'] for j in verb]
-                            key = self.classify_verb(tokens=tokens, pos=pos, lemmas=lemmas)
-                            delex.append(key)
-
-                            value = ' '.join(tokens).lower()
-                            dictionary.append((key, value))
-                            verb = []
-                    else:
+        return out['sentences'][0]
+
+
+    def delexicalize(self, snt):
+        delex, dictionary = [], []
+
+        tree = Tree(tree=snt['parse'], tokens=[], lemmas=[])
+        pos = [token['pos'] for token in snt['tokens']]
+        verb = []
+        for i, p in enumerate(pos):
+            if 'VB' in p:
+                if len(verb) > 0:
+                    if tree.verb_parent(i) == tree.verb_parent(verb[-1]):
                         verb.append(i)
-                else:
-                    if len(verb) > 0:
+                    else:
                         tokens = [snt['tokens'][j]['originalText'] for j in verb]
                         lemmas = [snt['tokens'][j]['lemma'] for j in verb]
                         pos = [snt['tokens'][j]['pos'] for j in verb]
@@ -578,13 +581,45 @@ class TemplateExtraction:
                         value = ' '.join(tokens).lower()
                         dictionary.append((key, value))
                         verb = []
-                    if p == 'DT':
-                        token = snt['tokens'][i]['originalText']
-                        lemma = snt['tokens'][i]['lemma']
-                        delex.append(self.classify_determiner(token, lemma))
-                    else:
-                        token = snt['tokens'][i]['originalText']
-                        delex.append(token)
+                else:
+                    verb.append(i)
+            else:
+                if len(verb) > 0:
+                    tokens = [snt['tokens'][j]['originalText'] for j in verb]
+                    lemmas = [snt['tokens'][j]['lemma'] for j in verb]
+                    pos = [snt['tokens'][j]['pos'] for j in verb]
+                    key = self.classify_verb(tokens=tokens, pos=pos, lemmas=lemmas)
+                    delex.append(key)
+
+                    value = ' '.join(tokens).lower()
+                    dictionary.append((key, value))
+                    verb = []
+                if p == 'DT':
+                    token = snt['tokens'][i]['originalText']
+                    lemma = snt['tokens'][i]['lemma']
+                    delex.append(self.classify_determiner(token, lemma))
+                else:
+                    token = snt['tokens'][i]['originalText']
+                    delex.append(token)
+
+        return delex, dictionary
+
+
+    def extract(self, template):
+        if template in self.memo:
+            delex, dictionary = self.memo[template]
+            return list(delex), list(dictionary)
+
+        text = template.replace('@', '')
+        dictionary = []
+
+        delex = []
+        sentences = self.tokenize(text)
+        for sentence in sentences:
+            snt = self.parse(sentence)
+            d, v = self.delexicalize(snt)
+            delex.extend(d)
+            dictionary.extend(v)
 
             # snt = out['sentences'][0]
             # strtree = snt['parse']
@@ -596,7 +631,57 @@ class TemplateExtraction:
             # dictionary.extend(d)
             # delex.extend(temp)
 
-        return delex, dictionary
+        self.memo[template] = (delex, dictionary)
+        return list(delex), list(dictionary)
+
+
+    def extract_batch(self, templates):
+        """
+        Extract the templates concurrently: the sentences of all templates are sent to CoreNLP by a pool of
+        threads and the results are assembled back in the order of the templates. Repeated templates, as well
+        as the ones extracted before in the same run, are only parsed once.
+        :param templates: list of templates
+        :return: list with a (template, dictionary) tuple per template, or None in case of a parsing error
+        """
+        def parse(sentence):
+            try:
+                return self.parse(sentence)
+            except AnnotationMissing:
+                raise
+            except:
+                return None
+
+        unique = list(dict.fromkeys([template for template in templates if template not in self.memo]))
+        print('Templates: {0} \t To parse: {1}'.format(len(templates), len(unique)))
+
+        start = time.time()
+        with ThreadPoolExecutor(self.workers) as pool:
+            sentences = list(pool.map(self.tokenize, [template.replace('@', '') for template in unique]))
+            parsed = iter(list(pool.map(parse, [sentence for snts in sentences for sentence in snts])))
+        nsentences = sum([len(snts) for snts in sentences])
+        elapsed = max(time.time() - start, 1e-6)
+        print('Parsed {0} sentences in {1}s ({2} sentences/s)'.format(nsentences, round(elapsed, 2), round(nsentences / elapsed, 2)))
+
+        for template, snts in zip(unique, sentences):
+            snts = [next(parsed) for _ in snts]
+            try:
+                delex, dictionary = [], []
+                for snt in snts:
+                    d, v = self.delexicalize(snt)
+                    delex.extend(d)
+                    dictionary.extend(v)
+                self.memo[template] = (delex, dictionary)
+            except:
+                pass
+
+        results = []
+        for template in templates:
+            if template in self.memo:
+                delex, dictionary = self.memo[template]
+                results.append((list(delex), list(dictionary)))
+            else:
+                results.append(None)
+        return results
 
 
     def __call__(self, entryset, lng='en'):
@@ -613,6 +698,8 @@ class TemplateExtraction:
                         lextemp, d = self.extract(template=lex.template_de)
                     self.dictionary.extend(d)
                     self.templates.append(lextemp)
+                except AnnotationMissing:
+                    raise
                 except:
                     errors += 1
 
@@ -645,7 +732,11 @@ class Lexicalization(Preprocess):
 
 
     def load(self, path):
-        entryset = parsing.run_parser(path)
+        entryset = parsing.run_cached_parser(path)
+
+        # templates of the whole split are extracted at once
+        extracted = iter(self.extractor.extract_batch([lex.template for entry in entryset for lex in entry.lexEntries]))
+        extracted = [[next(extracted) for lex in entry.lexEntries] for entry in entryset]
 
         data, size = [], 0
         invocab, outvocab, surfacevocab = [], [], []
@@ -654,6 +745,7 @@ class Lexicalization(Preprocess):
             progress = round(i / len(entryset), 2)
             print('Progress: {0} \t Errors: {1}'.format(progress, round(nerrors / len(entryset), 2)), end='\r')
             entitymap = {b:a for a, b in entry.entitymap_to_dict().items()}
+            templates = extracted[i]
 
             visited = []
             for lex in entry.lexEntries:
@@ -665,12 +757,14 @@ class Lexicalization(Preprocess):
                     invocab.extend(source)
 
                     targets = []
-                    for lex2 in entry.lexEntries:
+                    for j, lex2 in enumerate(entry.lexEntries):
                         _, target, entities = load.snt_source(lex2.orderedtripleset, entitymap, {})
 
                         if delex_source == target:
                             try:
-                                template, vocab = self.extractor.extract(lex2.template)
+                                # templates[j] is None when the template could not be parsed
+                                template, vocab = templates[j]
+                                template = list(template)
                                 surfacevocab.extend(vocab)
                                 for i, word in enumerate(template):
                                     if word in entities:
@@ -722,6 +816,8 @@ if __name__ == '__main__':
     data_path = sys.argv[1]
     write_path = sys.argv[2]
     STANFORD_PATH=sys.argv[3]
+    if len(sys.argv) > 4:
+        ANNOTATOR = sys.argv[4]
     temp = Lexicalization(data_path=data_path, write_path=write_path)
     temp()
 
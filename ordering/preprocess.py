@@ -10,8 +10,12 @@ Description:
         [1] Path to the folder where WebNLG corpus is available (versions/v1.4/en)
         [2] Path to the folder where the data will be saved (Folder will be created in case it does not exist)
 
+    ENVIRONMENT:
+        DEEPNLG_WORKERS: optional number of processes parsing the corpus files (1 by default)
+
     EXAMPLE:
         python3 preprocess.py ../versions/v1.4/en ordering/
+        DEEPNLG_WORKERS=8 python3 preprocess.py ../versions/v1.4/en ordering/
 """
 
 import sys
@@ -37,7 +41,7 @@ class Ordering(Preprocess):
 
 
     def load(self, path, augment=True):
-        entryset = parsing.run_parser(path)
+        entryset = parsing.run_cached_parser(path)
 
         data, size = [], 0
         invocab, outvocab = [], []
@@ -128,7 +132,7 @@ class Ordering(Preprocess):
 
 
     def load_simple(self, path):
-        entryset = parsing.run_parser(path)
+        entryset = parsing.run_cached_parser(path)
 
         data, size = [], 0
         invocab, outvocab = [], []
@@ -186,7 +190,7 @@ class Ordering(Preprocess):
 
 
     def load_index(self, path):
-        entryset = parsing.run_parser(path)
+        entryset = parsing.run_cached_parser(path)
 
         data, size = [], 0
         invocab, outvocab = [], []
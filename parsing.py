@@ -4,37 +4,73 @@ __author__ = 'thiagocastroferreira'
 Author: Thiago Castro Ferreira
 Date: 24/07/2017
 Description:
-    Parse and generate the WebNLG corpus in the xml format
+    Parse and generate the WebNLG corpus in the xml format. Parsing is streamed (iter_parser), so entries
+    can be consumed lazily without holding the whole corpus in memory. The parsed corpus may also be cached on disk
+    (iter_cached_parser / run_cached_parser), so that only the first preprocessing step has to parse the xml files.
+    Files are parsed and generated by a pool of DEEPNLG_WORKERS processes (environment variable, 1 by default)
 """
 
+import hashlib
+import json
+import multiprocessing
 import os
+import pickle
 import re
 import xml.etree.ElementTree as ET
-from xml.dom import minidom
+from sys import intern
+
+# Folder where the parsed corpora are cached
+CACHE_DIR = os.path.abspath(os.path.join('.cache', 'corpus'))
+# Update it whenever the parsed representation changes, so older caches are not loaded anymore
+CACHE_VERSION = 2
+# Number of processes parsing (and generating) the corpus files by default. The preprocessing scripts opt in to
+# the process pool with the environment variable DEEPNLG_WORKERS (e.g. DEEPNLG_WORKERS=8)
+WORKERS = int(os.environ.get('DEEPNLG_WORKERS', '1'))
 
 
 class Entry():
+    __slots__ = ('category', 'eid', 'size', 'originaltripleset', 'modifiedtripleset', 'entitymap', 'lexEntries')
+
     def __init__(self, category, eid, size, originaltripleset, modifiedtripleset, entitymap, lexEntries):
-        self.category = category
+        self.category = intern(category)
         self.eid = eid
-        self.size = size
+        self.size = intern(size)
         self.originaltripleset = originaltripleset
         self.modifiedtripleset = modifiedtripleset
         self.lexEntries = lexEntries
         self.entitymap = entitymap
 
+    def __reduce__(self):
+        return (Entry, (self.category, self.eid, self.size, self.originaltripleset, self.modifiedtripleset, \
+                        self.entitymap, self.lexEntries))
+
     def entitymap_to_dict(self):
         return dict(map(lambda tagentity: tagentity.to_tuple(), self.entitymap))
 
 class Triple():
+    __slots__ = ('subject', 'predicate', 'object')
+
     def __init__(self, subject, predicate, object):
-        self.subject = subject
-        self.predicate = predicate
-        self.object = object
+        self.subject = intern(subject)
+        self.predicate = intern(predicate)
+        self.object = intern(object)
+
+    def __reduce__(self):
+        return (Triple, (self.subject, self.predicate, self.object))
 
 class Lex():
+    # the german entry is rarely filled, so its fields are class-level defaults which only take
+    # space in the instance (__dict__) once they are assigned
+    __slots__ = ('comment', 'lid', 'text', 'template', 'tree', 'orderedtripleset', 'references', '__dict__')
+
+    text_de = ''
+    template_de = ''
+    tree_de = ''
+    orderedtripleset_de = ()
+    references_de = ()
+
     def __init__(self, comment, lid, text, template, orderedtripleset=[], references=[]):
-        self.comment = comment
+        self.comment = intern(comment)
         self.lid = lid
         self.text = text
         self.template = template
@@ -42,123 +78,259 @@ class Lex():
         self.orderedtripleset = orderedtripleset
         self.references = references
 
-        # german entry
-        self.text_de = ''
-        self.template_de = ''
-        self.tree_de = ''
-        self.orderedtripleset_de = []
-        self.references_de = []
+    def __reduce__(self):
+        # the tree and the german fields, when assigned, are restored as the state
+        return (Lex, (self.comment, self.lid, self.text, self.template, self.orderedtripleset, self.references), \
+                (self.__dict__ or None, {'tree': self.tree}))
 
 class TagEntity():
+    __slots__ = ('tag', 'entity')
+
     def __init__(self, tag, entity):
-        self.tag = tag
-        self.entity = entity
+        self.tag = intern(tag)
+        self.entity = intern(entity)
+
+    def __reduce__(self):
+        return (TagEntity, (self.tag, self.entity))
 
     def to_tuple(self):
         return (self.tag, self.entity)
 
 class Reference():
+    __slots__ = ('tag', 'entity', 'refex', 'number', 'reftype')
+
     def __init__(self, tag, entity, refex, number, reftype):
-        self.tag = tag
-        self.entity = entity
+        self.tag = intern(tag)
+        self.entity = intern(entity)
         self.refex = refex
         self.number = number
-        self.reftype = reftype
-
-def parse(in_file):
-    tree = ET.parse(in_file)
-    root = tree.getroot()
+        self.reftype = intern(reftype)
 
-    entries = root.find('entries')
+    def __reduce__(self):
+        return (Reference, (self.tag, self.entity, self.refex, self.number, self.reftype))
 
-    for entry in entries:
-        eid = entry.attrib['eid']
-        size = entry.attrib['size']
-        category = entry.attrib['category']
-
-        originaltripleset = []
-        otripleset = entry.find('originaltripleset')
-        for otriple in otripleset:
-            e1, pred, e2 = otriple.text.split(' | ')
-            originaltripleset.append(Triple(subject=e1.replace('\'', ''), predicate=pred, object=e2.replace('\'', '')))
-
-        modifiedtripleset = []
-        mtripleset = entry.find('modifiedtripleset')
-        for mtriple in mtripleset:
-            e1, pred, e2 = mtriple.text.split(' | ')
-
-            modifiedtripleset.append(Triple(subject=e1.replace('\'', ''), predicate=pred, object=e2.replace('\'', '')))
-
-        entitymap = []
-        mapping= entry.find('entitymap')
-        for entitytag in mapping:
-            tag, entity = entitytag.text.split(' | ')
-            entitymap.append(TagEntity(tag=tag, entity=entity))
-
-        lexList = []
-        lexEntries = entry.findall('lex')
-        for lex in lexEntries:
-            comment = lex.attrib['comment']
-            lid = lex.attrib['lid']
-
-            try:
-                orderedtripleset = []
-                otripleset = lex.find('sortedtripleset')
-                for snt in otripleset:
-                    orderedtripleset_snt = []
-                    for otriple in snt:
-                        e1, pred, e2 = otriple.text.split(' | ')
-
-                        orderedtripleset_snt.append(Triple(subject=e1.replace('\'', ''), predicate=pred, object=e2.replace('\'', '')))
-                    orderedtripleset.append(orderedtripleset_snt)
-            except:
-                orderedtripleset = []
-
-            try:
-                references = []
-                references_xml = lex.find('references')
-                for ref in references_xml:
-                    tag = ref.attrib['tag']
-                    entity = ref.attrib['entity']
-                    number = ref.attrib['number']
-                    reftype = ref.attrib['type']
-                    refex = ref.text
-                    references.append(Reference(tag=tag, entity=entity, number=number, reftype=reftype, refex=refex))
-            except:
-                references = []
-
-            try:
-                text = lex.find('text').text
-                if not text:
-                    text = ''
-            except:
-                print('exception text')
+def parse(in_file):
+    # stream the file: entries are parsed as soon as they are closed and released right after being consumed
+    entries = None
+    for event, element in ET.iterparse(in_file, events=('start', 'end')):
+        if event == 'start':
+            if element.tag == 'entries' and entries is None:
+                entries = element
+        elif element.tag == 'entry' and entries is not None:
+            yield parse_entry(element)
+            entries.clear()
+
+def parse_entry(entry):
+    eid = entry.attrib['eid']
+    size = entry.attrib['size']
+    category = entry.attrib['category']
+
+    originaltripleset = []
+    otripleset = entry.find('originaltripleset')
+    for otriple in otripleset:
+        e1, pred, e2 = otriple.text.split(' | ')
+        originaltripleset.append(Triple(subject=e1.replace('\'', ''), predicate=pred, object=e2.replace('\'', '')))
+
+    modifiedtripleset = []
+    mtripleset = entry.find('modifiedtripleset')
+    for mtriple in mtripleset:
+        e1, pred, e2 = mtriple.text.split(' | ')
+
+        modifiedtripleset.append(Triple(subject=e1.replace('\'', ''), predicate=pred, object=e2.replace('\'', '')))
+
+    entitymap = []
+    mapping= entry.find('entitymap')
+    for entitytag in mapping:
+        tag, entity = entitytag.text.split(' | ')
+        entitymap.append(TagEntity(tag=tag, entity=entity))
+
+    lexList = []
+    lexEntries = entry.findall('lex')
+    for lex in lexEntries:
+        comment = lex.attrib['comment']
+        lid = lex.attrib['lid']
+
+        try:
+            orderedtripleset = []
+            otripleset = lex.find('sortedtripleset')
+            for snt in otripleset:
+                orderedtripleset_snt = []
+                for otriple in snt:
+                    e1, pred, e2 = otriple.text.split(' | ')
+
+                    orderedtripleset_snt.append(Triple(subject=e1.replace('\'', ''), predicate=pred, object=e2.replace('\'', '')))
+                orderedtripleset.append(orderedtripleset_snt)
+        except:
+            orderedtripleset = []
+
+        try:
+            references = []
+            references_xml = lex.find('references')
+            for ref in references_xml:
+                tag = ref.attrib['tag']
+                entity = ref.attrib['entity']
+                number = ref.attrib['number']
+                reftype = ref.attrib['type']
+                refex = ref.text
+                references.append(Reference(tag=tag, entity=entity, number=number, reftype=reftype, refex=refex))
+        except:
+            references = []
+
+        try:
+            text = lex.find('text').text
+            if not text:
                 text = ''
+        except:
+            print('exception text')
+            text = ''
 
-            try:
-                template = lex.find('template').text
-                if not template:
-                    template = ''
-            except:
-                print('exception template')
+        try:
+            template = lex.find('template').text
+            if not template:
                 template = ''
+        except:
+            print('exception template')
+            template = ''
 
-            lexList.append(Lex(comment=comment, lid=lid, text=text, template=template, orderedtripleset=orderedtripleset, references=references))
+        lexList.append(Lex(comment=comment, lid=lid, text=text, template=template, orderedtripleset=orderedtripleset, references=references))
 
-        yield Entry(eid=eid, size=size, category=category, originaltripleset=originaltripleset, \
-                    modifiedtripleset=modifiedtripleset, entitymap=entitymap, lexEntries=lexList)
+    return Entry(eid=eid, size=size, category=category, originaltripleset=originaltripleset, \
+                 modifiedtripleset=modifiedtripleset, entitymap=entitymap, lexEntries=lexList)
 
-def run_parser(set_path):
-    entryset = []
+def corpus_files(set_path):
+    fnames = []
     dirtriples = filter(lambda item: not str(item).startswith('.'), os.listdir(set_path))
     for dirtriple in dirtriples:
         fcategories = filter(lambda item: not str(item).startswith('.'), os.listdir(os.path.join(set_path, dirtriple)))
         for fcategory in fcategories:
-            entryset.extend(list(parse(os.path.join(set_path, dirtriple, fcategory))))
-
-    return entryset
+            fnames.append(os.path.join(set_path, dirtriple, fcategory))
+    return fnames
+
+def parse_file(in_file):
+    return list(parse(in_file))
+
+def iter_parser(set_path, workers=WORKERS):
+    fnames = corpus_files(set_path)
+    if workers > 1:
+        # files are parsed concurrently, but imap returns them in the same order as they are listed
+        with multiprocessing.Pool(workers) as pool:
+            for entries in pool.imap(parse_file, fnames):
+                for entry in entries:
+                    yield entry
+    else:
+        for fname in fnames:
+            for entry in parse(fname):
+                yield entry
+
+def run_parser(set_path, workers=WORKERS):
+    return list(iter_parser(set_path, workers))
+
+def corpus_digest(set_path, cache_dir=CACHE_DIR):
+    """
+    Hash of the corpus content. Files are only re-hashed when their modification time or size change
+    with respect to the hashes saved in the cache manifest.
+    """
+    manifest_path = os.path.join(cache_dir, 'manifest.json')
+    try:
+        manifest = json.load(open(manifest_path))
+    except (IOError, ValueError):
+        manifest = {}
+
+    updated = False
+    digest = hashlib.sha1(str(CACHE_VERSION).encode('utf-8'))
+    for fname in corpus_files(set_path):
+        key = os.path.abspath(fname)
+        stat = os.stat(fname)
+        if key not in manifest or manifest[key][:2] != [stat.st_mtime_ns, stat.st_size]:
+            with open(fname, 'rb') as f:
+                fdigest = hashlib.sha1(f.read()).hexdigest()
+            manifest[key] = [stat.st_mtime_ns, stat.st_size, fdigest]
+            updated = True
+        digest.update(os.path.relpath(fname, set_path).encode('utf-8'))
+        digest.update(manifest[key][2].encode('utf-8'))
+
+    if updated:
+        tmp_path = manifest_path + '.' + str(os.getpid())
+        json.dump(manifest, open(tmp_path, 'w'))
+        os.replace(tmp_path, manifest_path)
+    return digest.hexdigest()
+
+def prune_cache(set_path, digest, cache_dir=CACHE_DIR):
+    """
+    Record digest as the current cache of the corpus in set_path and remove the cache it supersedes, unless it
+    is still the current cache of another corpus.
+    """
+    corpora_path = os.path.join(cache_dir, 'corpora.json')
+    try:
+        corpora = json.load(open(corpora_path))
+    except (IOError, ValueError):
+        corpora = {}
+
+    key = os.path.abspath(set_path)
+    old = corpora.get(key)
+    if old == digest:
+        return
+    corpora[key] = digest
+
+    tmp_path = corpora_path + '.' + str(os.getpid())
+    json.dump(corpora, open(tmp_path, 'w'))
+    os.replace(tmp_path, corpora_path)
+
+    if old is not None and old not in corpora.values():
+        try:
+            os.remove(os.path.join(cache_dir, old + '.pickle'))
+        except OSError:
+            # already removed (e.g. by another preprocessing step)
+            pass
+
+def iter_cached_parser(set_path, cache_dir=CACHE_DIR, workers=WORKERS):
+    """
+    Same as iter_parser, but entries are loaded from a binary (pickle) cache of the parsed corpus. The cache
+    is keyed by the content of the corpus files, so it is rebuilt whenever one of them changes, and the cache
+    of the former content is removed.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    digest = corpus_digest(set_path, cache_dir)
+    cache_path = os.path.join(cache_dir, digest + '.pickle')
+    if os.path.exists(cache_path):
+        prune_cache(set_path, digest, cache_dir)
+        with open(cache_path, 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    break
+    else:
+        # the cache only becomes visible once the whole corpus has been parsed
+        tmp_path = cache_path + '.' + str(os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                for entry in iter_parser(set_path, workers):
+                    pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    yield entry
+            os.replace(tmp_path, cache_path)
+            prune_cache(set_path, digest, cache_dir)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+def run_cached_parser(set_path, cache_dir=CACHE_DIR, workers=WORKERS):
+    return list(iter_cached_parser(set_path, cache_dir, workers))
+
+def entry_index(entryset):
+    # (eid, size, category) -> entry. The first entry is kept in case of duplicates
+    index = {}
+    for entry in entryset:
+        key = (entry.eid, entry.size, entry.category)
+        if key not in index:
+            index[key] = entry
+    return index
+
+def generate_tree(entryset, in_file, lng, index=None):
+    if index is None:
+        index = entry_index(entryset)
 
-def generate(entryset, in_file, out_file, lng):
     tree = ET.parse(in_file)
     root = tree.getroot()
 
@@ -183,7 +355,7 @@ def generate(entryset, in_file, out_file, lng):
         for modifiedtripleset in modifiedtriplesets[1:]:
             entry_xml.remove(modifiedtripleset)
 
-        entry = list(filter(lambda entry: entry.eid==eid and entry.size==str(size) and entry.category==category, entryset))[0]
+        entry = index[(eid, str(size), category)]
 
         tagentity = entry.entitymap_to_dict()
         for tag in sorted(tagentity.keys()):
@@ -254,14 +426,74 @@ def generate(entryset, in_file, out_file, lng):
             tree_xml = ET.SubElement(lexEntry_xml, 'tree')
             tree_xml.text = tree_
 
-    rough_string = ET.tostring(tree.getroot(), encoding='utf-8', method='xml')
-    rough_string = re.sub(">\n[\t]+<", '><', rough_string.decode('utf-8'))
-    xml = minidom.parseString(rough_string).toprettyxml(indent="\t")
+    return tree
+
+def generate(entryset, in_file, out_file, lng, index=None):
+    tree = generate_tree(entryset, in_file, lng, index=index)
+    with open(out_file, 'w', encoding='utf-8', newline='') as f:
+        write_xml(tree.getroot(), f)
+
+def escape_xml(data):
+    return data.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace('>', '&gt;')
+
+def xml_text(text):
+    # text as it is read back from a serialized tree, where whitespace that only formats the
+    # document (a newline followed by tabs) is ignored and line breaks are normalized
+    if not text or re.fullmatch('\n\t+', text):
+        return ''
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+def write_element(element, f, indent):
+    f.write(indent + '<' + element.tag)
+    for name, value in element.attrib.items():
+        f.write(' ' + name + '="' + escape_xml(value) + '"')
+
+    nodes = []
+    text = xml_text(element.text)
+    if text:
+        nodes.append(text)
+    for child in element:
+        nodes.append(child)
+        tail = xml_text(child.tail)
+        if tail:
+            nodes.append(tail)
+
+    if len(nodes) == 0:
+        f.write('/>\n')
+    elif len(nodes) == 1 and isinstance(nodes[0], str):
+        f.write('>' + escape_xml(nodes[0]) + '</' + element.tag + '>\n')
+    else:
+        f.write('>\n')
+        for node in nodes:
+            if isinstance(node, str):
+                f.write(escape_xml(indent + '\t' + node + '\n'))
+            else:
+                write_element(node, f, indent + '\t')
+        f.write(indent + '</' + element.tag + '>\n')
+
+def write_xml(root, f):
+    """
+    Write the tree straight to the file object in the same tab-indented format (byte by byte) as
+    minidom.toprettyxml, without serializing and parsing the document again
+    """
+    f.write('<?xml version="1.0" ?>\n')
+    write_element(root, f, '')
+
+# entry index shared by the worker processes of run_generator
+GENERATOR_INDEX = {}
+
+def init_generator(index):
+    global GENERATOR_INDEX
+    GENERATOR_INDEX = index
+
+def generate_file(args):
+    input_file, output_file, lng = args
+    generate([], input_file, output_file, lng, index=GENERATOR_INDEX)
 
-    with open(out_file, 'wb') as f:
-        f.write(xml.encode('utf-8'))
+def run_generator(entryset, input_dir, output_dir, lng, workers=WORKERS):
+    index = entry_index(entryset)
 
-def run_generator(entryset, input_dir, output_dir, lng):
+    jobs = []
     sizedirs = filter(lambda item: not str(item).startswith('.'), os.listdir(input_dir))
     for sizedir in sizedirs:
         out_sizedir = os.path.join(output_dir, sizedir)
@@ -272,4 +504,12 @@ def run_generator(entryset, input_dir, output_dir, lng):
         for xmlfile in xmlfiles:
             input_file = os.path.join(input_dir, sizedir, xmlfile)
             output_file = os.path.join(output_dir, sizedir, xmlfile)
-            generate(entryset, input_file, output_file, lng)
+            jobs.append((input_file, output_file, lng))
+
+    if workers > 1:
+        # the index is sent once to each worker, not once per file
+        with multiprocessing.Pool(workers, initializer=init_generator, initargs=(index,)) as pool:
+            pool.map(generate_file, jobs)
+    else:
+        for input_file, output_file, lng in jobs:
+            generate(entryset, input_file, output_file, lng, index=index)
@@ -4,49 +4,109 @@ __author__='thiagocastroferreira'
 Author: Thiago Castro Ferreira
 Date: 28/02/2019
 Description:
-    This script aims to generate the referring expressions.
+    This script aims to generate the referring expressions. Refexes decoded by NeuralREG (on DyNet or on
+    NumPy, see numpyreg.py) are cached in .cache/reg.db, so queries repeated across entries, runs and pipelines
+    are only decoded once per model.
 
     ARGS:
         [1] Path to the file with the Lexicalization step output
         [2] Path to the file with the Discourse Ordering step output
         [3] Path to the file where the output will be saved
-        [4] Flag to specify the model: NeuralREG -> neuralreg / OnlyName -> onlynames
-        [5] Path to the trained model
+        [4] Flag to specify the model: NeuralREG -> neuralreg / NeuralREG on NumPy -> numpyreg (numpyreg_float16 and
+            numpyreg_int8 with quantized weights) / OnlyName -> onlynames
+        [5] Path to the trained model (.npz exported by scripts/export_reg.py for numpyreg)
+        [6] Optional number of worker processes, each of them realizing a contiguous range of the entries
 
     EXAMPLE:
         python3 generate.py dev.lex.postprocessed dev.ordering.mapped dev.reg neuralreg reg/model1.dy
+        python3 generate.py dev.lex.postprocessed dev.ordering.mapped dev.reg neuralreg reg/model1.dy 4
+        python3 generate.py dev.lex.postprocessed dev.ordering.mapped dev.reg numpyreg reg/model1.npz
+        python3 generate.py dev.lex.postprocessed dev.ordering.mapped dev.reg numpyreg_int8 reg/model1.npz
 """
 
 import sys
 sys.path.append('./')
 sys.path.append('../')
 
-from neuralreg import NeuralREG
+from annotation import AnnotationCache
+import hashlib
+import json
+import multiprocessing
 import utils
 import re
 import os
 
+# Path to the cache of the refexes decoded by NeuralREG
+CACHE_PATH = os.path.abspath(os.path.join('.cache', 'reg.db'))
+
+# Flags of the NeuralREG models: DyNet, NumPy and NumPy with quantized weights
+NEURALREG_MODELS = ['neuralreg', 'numpyreg', 'numpyreg_float16', 'numpyreg_int8']
+
+# Configuration of NeuralREG at inference
+CONFIG = {
+    'LSTM_NUM_OF_LAYERS':1,
+    'EMBEDDINGS_SIZE':300,
+    'STATE_SIZE':512,
+    'ATTENTION_SIZE':512,
+    # no dropout: decoding is deterministic, so the cached refexes do not depend on the run which decoded them
+    'DROPOUT':0.0,
+    'GENERATION':30,
+    'BEAM_SIZE':5,
+    'BATCH_SIZE': 80,
+    'EPOCHS': 60,
+    'EARLY_STOP': 20,
+    # only the best refex is used
+    'EARLY_EXIT': True
+}
+
 
 class REG:
-    def __init__(self, model, model_path):
+    def __init__(self, model, model_path, cache_path=CACHE_PATH):
         self.model = model.strip()
-        if model == 'neuralreg':
-            config = {
-                'LSTM_NUM_OF_LAYERS':1,
-                'EMBEDDINGS_SIZE':300,
-                'STATE_SIZE':512,
-                'ATTENTION_SIZE':512,
-                'DROPOUT':0.2,
-                'GENERATION':30,
-                'BEAM_SIZE':5,
-                'BATCH_SIZE': 80,
-                'EPOCHS': 60,
-                'EARLY_STOP': 20
+        self.cache = None
+        if self.model in NEURALREG_MODELS:
+            path = os.path.abspath('evaluation/data/reg')
+            # the engines are only imported when used, so numpyreg runs without DyNet
+            if self.model == 'neuralreg':
+                from neuralreg import NeuralREG
+                self.neuralreg = NeuralREG(path=path, config=CONFIG)
+                self.neuralreg.populate(model_path)
+            else:
+                from numpyreg import NumpyREG
+                config = dict(CONFIG)
+                if self.model != 'numpyreg':
+                    config['QUANTIZATION'] = self.model.split('_')[1]
+                self.neuralreg = NumpyREG(path=path, config=config, weights_path=model_path)
+
+            # decoded refexes are cached across runs (and pipelines) of the same model and decoding settings
+            self.cache = AnnotationCache(path=cache_path)
+            self.properties = {
+                'model': self.checksum(model_path),
+                'beam': self.neuralreg.config.beam,
+                'max_len': self.neuralreg.config.max_len,
+                'early_exit': self.neuralreg.config.early_exit,
+                # refexes cached by the former runs with dropout are not reused
+                'dropout': self.neuralreg.config.dropout
             }
+            # the refexes of quantized weights may differ from the ones of the float model
+            if self.neuralreg.config.quantization is not None:
+                self.properties['quantization'] = self.neuralreg.config.quantization
 
-            path = os.path.abspath('evaluation/data/reg')
-            self.neuralreg = NeuralREG(path=path, config=config)
-            self.neuralreg.populate(model_path)
+    def checksum(self, path):
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    def lookup(self, query):
+        candidates = self.cache.get(query, self.properties)
+        if candidates is not None:
+            candidates = json.loads(candidates)
+        return candidates
+
+    def store(self, query, candidates):
+        self.cache.set(query, self.properties, json.dumps(candidates))
 
     def realize_date(self, entity):
         regex='([0-9]{4})-([0-9]{2})-([0-9]{2})'
@@ -84,57 +144,122 @@ class REG:
             return True, refex
         return False, ''
 
-    def realize(self, entry, entity_map):
+    def prepare(self, entry, entity_map):
+        """
+        Realize the mentions of an entry which do not need the NeuralREG model
+        :param entry: lexicalized entry
+        :param entity_map: entity tags to entities
+        :return: tokens of the entry, its context (the tokens between eos symbols, with the entities in place of
+        the tags) and the positions of the mentions to be realized by NeuralREG
+        """
         entry = entry.split()
-        pre_context = ['eos']
+        context = ['eos'] + [entity_map[token.strip()] if token.strip() in entity_map else token.strip().lower() for token in entry] + ['eos']
+        mentions = []
         for i, token in enumerate(entry):
             if token.strip() in entity_map:
                 entity = entity_map[token.strip()]
                 isDate, refex = self.realize_date(entity)
                 if not isDate:
                     try:
-                        isTrain = '_'.join(entity.split()) in self.neuralreg.vocab['input']
+                        isTrain = '_'.join(entity.split()) in self.neuralreg.input_vocab
                     except:
                         isTrain = False
-                    if entity[0] in ['\'', '\"'] or self.model != 'neuralreg' or not isTrain:
+                    if entity[0] in ['\'', '\"'] or self.model not in NEURALREG_MODELS or not isTrain:
                         refex = entity.replace('_', ' ').replace('\"', ' ').replace('\'', ' ')
                     else:
                         try:
                             refex = str(int(entity))
                         except ValueError:
-                            pos_context = []
-                            for j in range(i+1, len(entry)):
-                                if entry[j].strip() in entity_map:
-                                    pos_context.append(entity_map[entry[j].strip()])
-                                else:
-                                    pos_context.append(entry[j].strip().lower())
-                            pos_context.append('eos')
-                            candidates = self.neuralreg(pre_context=pre_context, pos_context=pos_context, entity=entity, beam=self.neuralreg.config.beam)
-                            refex = ' '.join(candidates[0]).replace('eos', '').strip()
+                            mentions.append(i)
 
                 entry[i] = refex
-                pre_context.append(entity)
-            else:
-                pre_context.append(token.lower())
-        return entry
+        return entry, context, mentions
 
-    def __call__(self, in_path, order_path, out_path):
+    def __call__(self, in_path, order_path, out_path, start=0, end=None):
         with open(in_path, encoding='utf-8') as f:
-            entries = f.read().split('\n')
+            entries = f.read().split('\n')[start:end]
 
         with open(order_path, encoding='utf-8') as f:
-            ordered_triples = [utils.split_triples(t.split()) for t in f.read().split('\n')]
+            ordered_triples = [utils.split_triples(t.split()) for t in f.read().split('\n')[start:end]]
 
         entity_maps = [utils.entity_mapping(t) for t in ordered_triples]
-        result = []
-        for i, entry in enumerate(entries):
-            print('Progress: ', round(i / len(entries), 2), end='\r')
-            result.append(self.realize(entry, entity_maps[i]))
-        # result = [self.realize(entry, entity_maps[i]) for i, entry in enumerate(entries)]
+        result = [self.prepare(entry, entity_maps[i]) for i, entry in enumerate(entries)]
+
+        # the mentions of all the entries are realized together: the (pre_context, pos_context, entity) queries which
+        # are not cached are decoded by entry, whose encoding is shared by its mentions, and their refexes put back
+        # in the entries
+        queries, mentions = [], []
+        for i, (entry, context, positions) in enumerate(result):
+            for j in positions:
+                queries.append((tuple(context[:j+1]), tuple(context[j+2:]), context[j+1]))
+                mentions.append((i, j))
+        if len(queries) > 0:
+            outputs = [self.lookup(query) for query in queries]
+            # positions (in the contexts) of the mentions to be decoded by entry, each query being decoded once
+            missing, todo = set(), {}
+            for query, candidates, (i, j) in zip(queries, outputs, mentions):
+                if candidates is None and query not in missing:
+                    missing.add(query)
+                    todo.setdefault(i, []).append(j+1)
+            print('REG queries: {0} \t Cache hits: {1} \t To decode: {2}'.format(len(queries), self.cache.hits, len(missing)))
+            # the cache is not locked while decoding, as it may be shared by other processes
+            self.cache.commit(force=True)
+
+            entries = [(result[i][1], positions) for i, positions in todo.items()]
+            decoded = {}
+            for (context, positions), candidates in zip(entries, self.neuralreg.realize_entries(entries, beam=self.neuralreg.config.beam)):
+                for position, mention_candidates in zip(positions, candidates):
+                    decoded[(tuple(context[:position]), tuple(context[position+1:]), context[position])] = mention_candidates
+            for query, candidates in decoded.items():
+                self.store(query, candidates)
+            self.cache.commit(force=True)
+
+            for k, (i, j) in enumerate(mentions):
+                candidates = outputs[k] if outputs[k] is not None else decoded[queries[k]]
+                result[i][0][j] = ' '.join(candidates[0]).replace('eos', '').strip()
+
         with open(out_path, 'w', encoding='utf-8') as f:
-            out = [' '.join(predicates) for predicates in result]
+            out = [' '.join(entry) for entry, _, _ in result]
             f.write('\n'.join(out))
 
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+
+
+def generate_shard(job):
+    model, model_path, in_path, order_path, out_path, start, end = job
+    reg = REG(model=model, model_path=model_path)
+    reg(in_path=in_path, order_path=order_path, out_path=out_path, start=start, end=end)
+    reg.close()
+    return out_path
+
+
+def run_sharded(model, model_path, in_path, order_path, out_path, workers):
+    with open(in_path, encoding='utf-8') as f:
+        size = len(f.read().split('\n'))
+    workers = max(1, min(workers, size))
+
+    # contiguous (non-empty) ranges of entries, one per worker
+    bounds = [i * size // workers for i in range(workers + 1)]
+    jobs = []
+    for i in range(workers):
+        shard_path = '{0}.shard{1}'.format(out_path, i)
+        jobs.append((model, model_path, in_path, order_path, shard_path, bounds[i], bounds[i+1]))
+
+    # workers are spawned (DyNet is not fork-safe) and load the model once each
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        shards = pool.map(generate_shard, jobs)
+
+    # shards are merged in the order of the entries
+    with open(out_path, 'w', encoding='utf-8') as f:
+        for i, shard_path in enumerate(shards):
+            with open(shard_path, encoding='utf-8') as shard:
+                if i > 0:
+                    f.write('\n')
+                f.write(shard.read())
+            os.remove(shard_path)
+
 
 if __name__ == '__main__':
     path = os.path.abspath('DeepNLG/results/lexicalization/surfacevocab.json')
@@ -144,5 +269,10 @@ if __name__ == '__main__':
     out_path = sys.argv[3]
     model = sys.argv[4]
     model_path = sys.argv[5]
-    model = REG(model=model, model_path=model_path)
-    model(in_path=in_path, order_path=order_path, out_path=out_path)
+    workers = int(sys.argv[6]) if len(sys.argv) > 6 else 1
+    if workers > 1:
+        run_sharded(model=model, model_path=model_path, in_path=in_path, order_path=order_path, out_path=out_path, workers=workers)
+    else:
+        model = REG(model=model, model_path=model_path)
+        model(in_path=in_path, order_path=order_path, out_path=out_path)
+        model.close()
@@ -0,0 +1,70 @@
+"""
+Description:
+    Configuration and vocabularies of the NeuralREG models, shared by the DyNet model (neuralreg.NeuralREG)
+    and its numpy inference engine (numpyreg.NumpyREG), without depending on DyNet.
+
+    Config(config): hyperparameters and decoding settings (see neuralreg.py)
+    Vocab(words, unknown): word <-> id mapping of the input or output vocabulary
+
+    PYTHON VERSION: 3
+
+    DEPENDENCIES:
+        NumPy: http://www.numpy.org/
+"""
+
+import numpy as np
+
+
+class Config:
+    def __init__(self, config):
+        self.lstm_depth = config['LSTM_NUM_OF_LAYERS']
+        self.embedding_dim = config['EMBEDDINGS_SIZE']
+        self.state_dim = config['STATE_SIZE']
+        self.attention_dim = config['ATTENTION_SIZE']
+        self.dropout = config['DROPOUT']
+        self.max_len = config['GENERATION']
+        self.beam = config['BEAM_SIZE']
+        self.batch = config['BATCH_SIZE']
+        self.early_stop = config['EARLY_STOP']
+        self.epochs = config['EPOCHS']
+        # the graph of a batch keeps the attention of every candidate at every step, so batches are small
+        self.decode_batch = config.get('DECODE_BATCH', 4)
+        self.early_exit = config.get('EARLY_EXIT', False)
+        # weights of the numpy inference engine: None (float32), 'float16' or 'int8'
+        self.quantization = config.get('QUANTIZATION', None)
+
+
+class Vocab:
+    def __init__(self, words, unknown):
+        self.int2word = list(words)
+        self.word2int = {w:i for i, w in enumerate(self.int2word)}
+        # words out of the vocabulary are encoded as the unknown symbol
+        self.unknown = self.word2int[unknown]
+
+
+    def __len__(self):
+        return len(self.int2word)
+
+
+    def __contains__(self, word):
+        return word in self.word2int
+
+
+    def __getitem__(self, word):
+        return self.word2int[word]
+
+
+    def get(self, word):
+        return self.word2int.get(word, self.unknown)
+
+
+    def encode(self, sentence):
+        return np.fromiter(map(self.get, sentence), dtype=np.int64, count=len(sentence))
+
+
+    def encode_batch(self, sentences):
+        # ids (max length x batch size) of the sentences, padded with the unknown symbol
+        ids = np.full((max([len(sentence) for sentence in sentences]), len(sentences)), self.unknown, dtype=np.int64)
+        for j, sentence in enumerate(sentences):
+            ids[:len(sentence), j] = self.encode(sentence)
+        return ids
@@ -18,11 +18,20 @@ Description:
             CHARACTER: character- (True) or word-based decoder
             GENERATION: max output limit
             BEAM_SIZE: beam search size
+            DECODE_BATCH: number of queries decoded together by batch_beam_search and realize_entries (optional, 4
+                by default)
+            EARLY_EXIT: stop the beam search of a query once none of its live candidates can beat its best
+                finished one after length normalization. The best output is the same, but fewer candidates are
+                returned (optional, False by default)
 
         train()
             :param fdir
                 Directory to save best results and model
 
+        export(path)
+            :param path
+                .npz file with the parameters, to be run by the numpy inference engine (numpyreg.py)
+
     PYTHON VERSION: 3
 
     DEPENDENCIES:
@@ -39,19 +48,10 @@ import dynet as dy
 import json
 import numpy as np
 import os
+import random
 
-class Config:
-    def __init__(self, config):
-        self.lstm_depth = config['LSTM_NUM_OF_LAYERS']
-        self.embedding_dim = config['EMBEDDINGS_SIZE']
-        self.state_dim = config['STATE_SIZE']
-        self.attention_dim = config['ATTENTION_SIZE']
-        self.dropout = config['DROPOUT']
-        self.max_len = config['GENERATION']
-        self.beam = config['BEAM_SIZE']
-        self.batch = config['BATCH_SIZE']
-        self.early_stop = config['EARLY_STOP']
-        self.epochs = config['EPOCHS']
+from model import Config, Vocab
+from search import beam_search, top_k
 
 class NeuralREG():
     def __init__(self, config, path):
@@ -60,19 +60,40 @@ class NeuralREG():
 
         self.EOS = "eos"
         self.vocab = json.load(open(os.path.join(self.path, 'vocab.json')))
-        self.trainset = json.load(open(os.path.join(self.path, 'train.json')))
-        self.devset = json.load(open(os.path.join(self.path, 'dev.json')))
-        self.testset = json.load(open(os.path.join(self.path, 'test.json')))
+        # the datasets are only read when first used, so inference only needs the vocabulary
+        self.datasets = {}
 
-        self.int2input = list(self.vocab['input'])
-        self.input2int = {c:i for i, c in enumerate(self.vocab['input'])}
+        self.input_vocab = Vocab(self.vocab['input'], self.EOS)
+        self.int2input, self.input2int = self.input_vocab.int2word, self.input_vocab.word2int
 
-        self.int2output = list(self.vocab['output'])
-        self.output2int = {c:i for i, c in enumerate(self.vocab['output'])}
+        self.output_vocab = Vocab(self.vocab['output'], self.EOS)
+        self.int2output, self.output2int = self.output_vocab.int2word, self.output_vocab.word2int
 
         self.init()
 
 
+    def load_set(self, name):
+        if name not in self.datasets:
+            with open(os.path.join(self.path, name + '.json'), encoding='utf-8') as f:
+                self.datasets[name] = json.load(f)
+        return self.datasets[name]
+
+
+    @property
+    def trainset(self):
+        return self.load_set('train')
+
+
+    @property
+    def devset(self):
+        return self.load_set('dev')
+
+
+    @property
+    def testset(self):
+        return self.load_set('test')
+
+
     def init(self):
         dy.renew_cg()
 
@@ -115,15 +136,7 @@ class NeuralREG():
 
 
     def embed_sentence(self, sentence):
-        _sentence = list(sentence)
-        sentence = []
-        for w in _sentence:
-            try:
-                sentence.append(self.input2int[w])
-            except:
-                sentence.append(self.input2int[self.EOS])
-
-        return [self.input_lookup[char] for char in sentence]
+        return [self.input_lookup[char] for char in self.input_vocab.encode(sentence).tolist()]
 
 
     def run_lstm(self, init_state, input_vecs):
@@ -137,6 +150,17 @@ class NeuralREG():
         return out_vectors
 
 
+    def embed_batch(self, sentences):
+        # sentences are padded with EOS up to the longest one in the batch: one batched lookup per position
+        ids = self.input_vocab.encode_batch(sentences)
+        return [dy.lookup_batch(self.input_lookup, position.tolist()) for position in ids]
+
+
+    def batch_mask(self, lengths):
+        # mask (max length x batch size) with 1 in the positions of the sentences and 0 in the padding
+        return np.array([[1.0 if i < length else 0.0 for length in lengths] for i in range(max(lengths))])
+
+
     def encode_sentence(self, enc_fwd_lstm, enc_bwd_lstm, sentence):
         sentence_rev = list(reversed(sentence))
 
@@ -148,13 +172,45 @@ class NeuralREG():
         return vectors
 
 
-    def attend(self, h, state, w1dt, attention_w2, attention_v):
-        # input_mat: (encoder_state x seqlen) => input vecs concatenated as cols
-        # w1dt: (attdim x seqlen)
-        # w2dt: (attdim x attdim)
-        w2dt = attention_w2*dy.concatenate(list(state.s()))
+    def encode_batch(self, enc_fwd_lstm, enc_bwd_lstm, embedded, mask):
+        batch_size = mask.shape[1]
+        # dropout masks are sampled per batch element (initial_state samples a single mask)
+        s = enc_fwd_lstm.initial_state()
+        enc_fwd_lstm.set_dropout_masks(batch_size)
+        fwd_vectors = self.run_lstm(s, embedded)
+
+        # the padding is read first by the backward encoder, whose state is kept at zero (the initial state)
+        # until the sentence starts
+        s = enc_bwd_lstm.initial_state([dy.zeros(self.config.state_dim, batch_size=batch_size) for _ in range(2 * self.config.lstm_depth)])
+        enc_bwd_lstm.set_dropout_masks(batch_size)
+        bwd_vectors = []
+        for vector, step_mask in zip(reversed(embedded), reversed(mask)):
+            s = s.add_input(vector)
+            if step_mask.min() == 0.0:
+                step_mask = dy.inputTensor(step_mask, batched=True)
+                s = s.set_s([state * step_mask for state in s.s()])
+            bwd_vectors.append(s.output())
+        bwd_vectors = list(reversed(bwd_vectors))
+        vectors = [dy.concatenate(list(p)) for p in zip(fwd_vectors, bwd_vectors)]
+
+        return vectors
+
+
+    def attend_contexts(self, state, h_pre, w1dt_pre, h_pos, w1dt_pos, bias_pre=None, bias_pos=None):
+        # attention over the pre- and pos-contexts, which share the decoder state. The keys w1dt are
+        # projected once per encoding by the caller
+        state = dy.concatenate(list(state.s()))
+        attention_pre = self.attention_context(h_pre, w1dt_pre, self.attention_w2_pre*state, self.attention_v_pre, bias_pre)
+        attention_pos = self.attention_context(h_pos, w1dt_pos, self.attention_w2_pos*state, self.attention_v_pos, bias_pos)
+        return attention_pre, attention_pos
+
+
+    def attention_context(self, h, w1dt, w2dt, attention_v, bias=None):
         # att_weights: (seqlen,) row vector
         unnormalized = dy.transpose(attention_v * dy.tanh(dy.colwise_add(w1dt, w2dt)))
+        # bias: (seqlen,) with large negative values on the padding of batched sentences
+        if bias is not None:
+            unnormalized = unnormalized + bias
         att_weights = dy.softmax(unnormalized)
         # context: (encoder_state)
         context = h * att_weights
@@ -165,24 +221,20 @@ class NeuralREG():
         output = list(output)
         output = [self.output2int[c] for c in output]
 
+        # the keys are projected once for the entire decoding phase
         h_pre = dy.concatenate_cols(pre_encoded)
-        w1dt_pre = None
+        w1dt_pre = self.attention_w1_pre * h_pre
 
         h_pos = dy.concatenate_cols(pos_encoded)
-        w1dt_pos = None
+        w1dt_pos = self.attention_w1_pos * h_pos
 
         last_output_embeddings = self.output_lookup[self.output2int[self.EOS]]
-        entity_embedding = self.input_lookup[self.input2int[entity]]
+        entity_embedding = self.input_lookup[self.input_vocab.get(entity)]
         s = self.dec_lstm.initial_state().add_input(dy.concatenate([dy.vecInput(self.config.state_dim*4), last_output_embeddings, entity_embedding]))
         loss = []
 
         for word in output:
-            # w1dt can be computed and cached once for the entire decoding phase
-            w1dt_pre = w1dt_pre or self.attention_w1_pre * h_pre
-            w1dt_pos = w1dt_pos or self.attention_w1_pos * h_pos
-
-            attention_pre = self.attend(h_pre, s, w1dt_pre, self.attention_w2_pre, self.attention_v_pre)
-            attention_pos = self.attend(h_pos, s, w1dt_pos, self.attention_w2_pos, self.attention_v_pos)
+            attention_pre, attention_pos = self.attend_contexts(s, h_pre, w1dt_pre, h_pos, w1dt_pos)
 
             vector = dy.concatenate([attention_pre, attention_pos, last_output_embeddings, entity_embedding])
             s = s.add_input(vector)
@@ -194,6 +246,42 @@ class NeuralREG():
         return loss
 
 
+    def decode_batch(self, pre_encoded, pre_mask, pos_encoded, pos_mask, outputs, entities):
+        batch_size = len(outputs)
+        length = max([len(output) for output in outputs])
+        eos = self.output2int[self.EOS]
+        output_mask = self.batch_mask([len(output) for output in outputs])
+        outputs = [[self.output2int[c] for c in output] + (length - len(output)) * [eos] for output in outputs]
+
+        h_pre = dy.concatenate_cols(pre_encoded)
+        w1dt_pre = self.attention_w1_pre * h_pre
+        bias_pre = dy.inputTensor((1.0 - pre_mask) * -1e9, batched=True)
+
+        h_pos = dy.concatenate_cols(pos_encoded)
+        w1dt_pos = self.attention_w1_pos * h_pos
+        bias_pos = dy.inputTensor((1.0 - pos_mask) * -1e9, batched=True)
+
+        last_output_embeddings = dy.lookup_batch(self.output_lookup, batch_size * [eos])
+        entity_embedding = dy.lookup_batch(self.input_lookup, self.input_vocab.encode(entities).tolist())
+        s = self.dec_lstm.initial_state()
+        self.dec_lstm.set_dropout_masks(batch_size)
+        s = s.add_input(dy.concatenate([dy.zeros(self.config.state_dim*4, batch_size=batch_size), last_output_embeddings, entity_embedding]))
+        loss = []
+
+        for i in range(length):
+            attention_pre, attention_pos = self.attend_contexts(s, h_pre, w1dt_pre, h_pos, w1dt_pos, bias_pre, bias_pos)
+
+            vector = dy.concatenate([attention_pre, attention_pos, last_output_embeddings, entity_embedding])
+            s = s.add_input(vector)
+            out_vector = self.decoder_w * s.output() + self.decoder_b
+            words = [output[i] for output in outputs]
+            last_output_embeddings = dy.lookup_batch(self.output_lookup, words)
+            word_loss = dy.pickneglogsoftmax_batch(out_vector, words)
+            loss.append(dy.cmult(word_loss, dy.inputTensor(output_mask[i], batched=True)))
+        loss = dy.sum_batches(dy.esum(loss))
+        return loss
+
+
     def generate(self, pre_context, pos_context, entity):
         embedded = self.embed_sentence(pre_context)
         pre_encoded = self.encode_sentence(self.encpre_fwd_lstm, self.encpre_bwd_lstm, embedded)
@@ -201,35 +289,28 @@ class NeuralREG():
         embedded = self.embed_sentence(pos_context)
         pos_encoded = self.encode_sentence(self.encpos_fwd_lstm, self.encpos_bwd_lstm, embedded)
 
+        # the keys are projected once for the entire decoding phase
         h_pre = dy.concatenate_cols(pre_encoded)
-        w1dt_pre = None
+        w1dt_pre = self.attention_w1_pre * h_pre
 
         h_pos = dy.concatenate_cols(pos_encoded)
-        w1dt_pos = None
+        w1dt_pos = self.attention_w1_pos * h_pos
 
         last_output_embeddings = self.output_lookup[self.output2int[self.EOS]]
-        try:
-            entity_embedding = self.input_lookup[self.input2int[entity]]
-        except:
-            entity_embedding = self.input_lookup[self.input2int[self.EOS]]
+        entity_embedding = self.input_lookup[self.input_vocab.get(entity)]
         s = self.dec_lstm.initial_state().add_input(dy.concatenate([dy.vecInput(self.config.state_dim*4), last_output_embeddings, entity_embedding]))
 
         out = []
         count_EOS = 0
         for i in range(self.config.max_len):
             if count_EOS == 2: break
-            # w1dt can be computed and cached once for the entire decoding phase
-            w1dt_pre = w1dt_pre or self.attention_w1_pre * h_pre
-            w1dt_pos = w1dt_pos or self.attention_w1_pos * h_pos
-
-            attention_pre = self.attend(h_pre, s, w1dt_pre, self.attention_w2_pre, self.attention_v_pre)
-            attention_pos = self.attend(h_pos, s, w1dt_pos, self.attention_w2_pos, self.attention_v_pos)
+            attention_pre, attention_pos = self.attend_contexts(s, h_pre, w1dt_pre, h_pos, w1dt_pos)
 
             vector = dy.concatenate([attention_pre, attention_pos, last_output_embeddings, entity_embedding])
             s = s.add_input(vector)
             out_vector = self.decoder_w * s.output() + self.decoder_b
-            probs = dy.softmax(out_vector).vec_value()
-            next_word = probs.index(max(probs))
+            probs = dy.softmax(out_vector).npvalue()
+            next_word = int(top_k(probs, 1)[0])
             last_output_embeddings = self.output_lookup[next_word]
             if self.int2output[next_word] == self.EOS:
                 count_EOS += 1
@@ -245,6 +326,114 @@ class NeuralREG():
         return self.beam_search(pre_context, pos_context, entity, beam)
 
 
+    def encode_entry(self, context):
+        """
+        Encoding shared by the mentions of an entry, whose contexts are slices of the same token sequence: the
+        mention at position i has context[:i] as pre-context and context[i+1:] as pos-context. The forward
+        states of the pre-contexts (prefixes) and the backward states of the pos-contexts (suffixes), as well as
+        their attention projections, do not depend on the mention and are computed once.
+        :param context: tokens of the entry between eos symbols, with the entity names in place of the mentions
+        :return: encoding to be used by encode_mention
+        """
+        state_dim = self.config.state_dim
+
+        embedded = self.embed_sentence(context)
+        pre_fwd = self.run_lstm(self.encpre_fwd_lstm.initial_state(), embedded[:-1])
+        pos_bwd = self.run_lstm(self.encpos_bwd_lstm.initial_state(), list(reversed(embedded[1:])))
+        pos_bwd = list(reversed(pos_bwd))
+
+        # attention_w1 * [fwd; bwd] = attention_w1[:, :state_dim] * fwd + attention_w1[:, state_dim:] * bwd
+        w1_pre, w1_pos = self.attention_w1_pre.expr(), self.attention_w1_pos.expr()
+        encoding = {
+            'size': len(context),
+            'embedded': embedded,
+            'pre_fwd': pre_fwd,
+            'pos_bwd': pos_bwd,
+            'w1_pre_bwd': dy.select_cols(w1_pre, list(range(state_dim, 2*state_dim))),
+            'w1_pos_fwd': dy.select_cols(w1_pos, list(range(state_dim))),
+            'w1dt_pre_fwd': dy.select_cols(w1_pre, list(range(state_dim))) * dy.concatenate_cols(pre_fwd),
+            'w1dt_pos_bwd': dy.select_cols(w1_pos, list(range(state_dim, 2*state_dim))) * dy.concatenate_cols(pos_bwd)
+        }
+        return encoding
+
+
+    def encode_mention(self, encoding, position):
+        """
+        Encoded pre- and pos-contexts of the mention at a position of an entry: only the backward states of the
+        pre-context and the forward states of the pos-context are computed
+        :return: h_pre, w1dt_pre, h_pos and w1dt_pos of the mention
+        """
+        embedded = encoding['embedded']
+
+        pre_fwd = encoding['pre_fwd'][:position]
+        pre_bwd = self.run_lstm(self.encpre_bwd_lstm.initial_state(), list(reversed(embedded[:position])))
+        pre_bwd = list(reversed(pre_bwd))
+        h_pre = dy.concatenate_cols([dy.concatenate(list(p)) for p in zip(pre_fwd, pre_bwd)])
+        w1dt_pre = dy.select_cols(encoding['w1dt_pre_fwd'], list(range(position))) + encoding['w1_pre_bwd'] * dy.concatenate_cols(pre_bwd)
+
+        pos_fwd = self.run_lstm(self.encpos_fwd_lstm.initial_state(), embedded[position+1:])
+        pos_bwd = encoding['pos_bwd'][position:]
+        h_pos = dy.concatenate_cols([dy.concatenate(list(p)) for p in zip(pos_fwd, pos_bwd)])
+        w1dt_pos = encoding['w1_pos_fwd'] * dy.concatenate_cols(pos_fwd) + dy.select_cols(encoding['w1dt_pos_bwd'], list(range(position, encoding['size']-1)))
+
+        return h_pre, w1dt_pre, h_pos, w1dt_pos
+
+
+    def batch_cols(self, exprs, lengths):
+        # batch of (dim x length) expressions, padded with zero columns up to the longest one
+        size = max(lengths)
+        padded = [expr if length == size else dy.concatenate_cols([expr, dy.zeros((expr.dim()[0][0], size - length))]) for expr, length in zip(exprs, lengths)]
+        return dy.concatenate_to_batch(padded)
+
+
+    def realize_entries(self, entries, beam):
+        """
+        Beam search of the mentions of many entries. The encoding of an entry is shared by its mentions (see
+        encode_entry) and the mentions of consecutive entries, about DECODE_BATCH of them, are decoded together.
+        :param entries: list of (context, positions) tuples, positions being the indices of the mentions in the context
+        :return: candidates of every mention (as returned by beam_search), by entry
+        """
+        groups, group, size = [], [], 0
+        for i, (_, positions) in enumerate(entries):
+            group.append(i)
+            size += len(positions)
+            if size >= self.config.decode_batch:
+                groups.append(group)
+                group, size = [], 0
+        if len(group) > 0:
+            groups.append(group)
+
+        results = [[] for _ in entries]
+        for k, group in enumerate(groups):
+            print('Progress: ', round(k / len(groups), 2), end='\r')
+            dy.renew_cg()
+
+            mentions, entities = [], []
+            for i in group:
+                context, positions = entries[i]
+                if len(positions) == 0:
+                    continue
+                encoding = self.encode_entry(context)
+                for position in positions:
+                    mentions.append((position, encoding['size'] - 1 - position, self.encode_mention(encoding, position)))
+                    entities.append(context[position])
+            if len(mentions) == 0:
+                continue
+
+            pre_lengths, pos_lengths = [m[0] for m in mentions], [m[1] for m in mentions]
+            h_pre = self.batch_cols([m[2][0] for m in mentions], pre_lengths)
+            w1dt_pre = self.batch_cols([m[2][1] for m in mentions], pre_lengths)
+            bias_pre = dy.inputTensor((1.0 - self.batch_mask(pre_lengths)) * -1e9, batched=True)
+            h_pos = self.batch_cols([m[2][2] for m in mentions], pos_lengths)
+            w1dt_pos = self.batch_cols([m[2][3] for m in mentions], pos_lengths)
+            bias_pos = dy.inputTensor((1.0 - self.batch_mask(pos_lengths)) * -1e9, batched=True)
+
+            outputs = iter(self.beam_decode(h_pre, w1dt_pre, h_pos, w1dt_pos, entities, beam, bias_pre, bias_pos))
+            for i in group:
+                results[i] = [next(outputs) for _ in entries[i][1]]
+        return results
+
+
     def beam_search(self, pre_context, pos_context, entity, beam):
         embedded = self.embed_sentence(pre_context)
         pre_encoded = self.encode_sentence(self.encpre_fwd_lstm, self.encpre_bwd_lstm, embedded)
@@ -253,81 +442,91 @@ class NeuralREG():
         pos_encoded = self.encode_sentence(self.encpos_fwd_lstm, self.encpos_bwd_lstm, embedded)
 
         h_pre = dy.concatenate_cols(pre_encoded)
-        w1dt_pre = None
+        w1dt_pre = self.attention_w1_pre * h_pre
 
         h_pos = dy.concatenate_cols(pos_encoded)
-        w1dt_pos = None
+        w1dt_pos = self.attention_w1_pos * h_pos
+
+        return self.beam_decode(h_pre, w1dt_pre, h_pos, w1dt_pos, [entity], beam)[0]
+
+
+    def batch_beam_search(self, queries, beam):
+        """
+        Beam search over many queries at once. Queries with similar context lengths are encoded as padded
+        batches and their candidates are decoded together.
+        :param queries: list of (pre_context, pos_context, entity) tuples
+        :param beam: beam size
+        :return: candidates of every query (as returned by beam_search), in the order of the queries
+        """
+        size = self.config.decode_batch
+        order = sorted(range(len(queries)), key=lambda i: (len(queries[i][0]), len(queries[i][1])))
+
+        results = len(queries) * [None]
+        for start in range(0, len(order), size):
+            print('Progress: ', round(start / len(order), 2), end='\r')
+            batch = [queries[i] for i in order[start:start+size]]
+            dy.renew_cg()
 
-        try:
-            entity_embedding = self.input_lookup[self.input2int[entity]]
-        except:
-            entity_embedding = self.input_lookup[self.input2int[self.EOS]]
-        last_output_embeddings = self.output_lookup[self.output2int[self.EOS]]
-        s = self.dec_lstm.initial_state().add_input(dy.concatenate([dy.vecInput(self.config.state_dim*4), last_output_embeddings, entity_embedding]))
-        candidates = [{'sentence':[self.EOS], 'prob':0.0, 'count_EOS':0, 's':s}]
-        outputs = []
-
-        i = 0
-        while i < self.config.max_len and len(outputs) < beam:
-            new_candidates = []
-            for candidate in candidates:
-                if candidate['count_EOS'] == 2:
-                    outputs.append(candidate)
-
-                    if len(outputs) == beam: break
-                else:
-                    # w1dt can be computed and cached once for the entire decoding phase
-                    w1dt_pre = w1dt_pre or self.attention_w1_pre * h_pre
-                    w1dt_pos = w1dt_pos or self.attention_w1_pos * h_pos
-
-                    attention_pre = self.attend(h_pre, candidate['s'], w1dt_pre, self.attention_w2_pre, self.attention_v_pre)
-                    attention_pos = self.attend(h_pos, candidate['s'], w1dt_pos, self.attention_w2_pos, self.attention_v_pos)
-
-                    last_output_embeddings = self.output_lookup[self.output2int[candidate['sentence'][-1]]]
-                    vector = dy.concatenate([attention_pre, attention_pos, last_output_embeddings, entity_embedding])
-                    s = candidate['s'].add_input(vector)
-                    out_vector = self.decoder_w * s.output() + self.decoder_b
-                    probs = dy.softmax(out_vector).vec_value()
-                    next_words = [{'prob':e, 'index':probs.index(e)} for e in sorted(probs, reverse=True)[:beam]]
-
-                    for next_word in next_words:
-                        word = self.int2output[next_word['index']]
-
-                        new_candidate = {
-                            'sentence': candidate['sentence'] + [word],
-                            'prob': candidate['prob'] + np.log(next_word['prob']),
-                            'count_EOS': candidate['count_EOS'],
-                            's':s
-                        }
-
-                        if word == self.EOS:
-                            new_candidate['count_EOS'] += 1
-
-                        new_candidates.append(new_candidate)
-
-            # # Length Normalization
-            # alpha = 0.6
-            # for candidate in new_candidates:
-            #     length = len(candidate['sentence'])
-            #     lp_y = ((5.0 + length)**alpha) / ((5.0+1.0)**alpha)
-            #
-            #     candidate['prob'] /= lp_y
-            candidates = sorted(new_candidates, key=lambda x: x['prob'], reverse=True)[:beam]
-            i += 1
-
-        if len(outputs) == 0:
-            outputs = candidates
-
-        # Length Normalization
-        alpha = 0.6
-        for output in outputs:
-            length = len(output['sentence'])
-            lp_y = ((5.0 + length)**alpha) / ((5.0+1.0)**alpha)
+            pre_contexts = [pre_context for pre_context, _, _ in batch]
+            pre_mask = self.batch_mask([len(pre_context) for pre_context in pre_contexts])
+            embedded = self.embed_batch(pre_contexts)
+            pre_encoded = self.encode_batch(self.encpre_fwd_lstm, self.encpre_bwd_lstm, embedded, pre_mask)
+
+            pos_contexts = [pos_context for _, pos_context, _ in batch]
+            pos_mask = self.batch_mask([len(pos_context) for pos_context in pos_contexts])
+            embedded = self.embed_batch(pos_contexts)
+            pos_encoded = self.encode_batch(self.encpos_fwd_lstm, self.encpos_bwd_lstm, embedded, pos_mask)
+
+            h_pre = dy.concatenate_cols(pre_encoded)
+            w1dt_pre = self.attention_w1_pre * h_pre
+            bias_pre = dy.inputTensor((1.0 - pre_mask) * -1e9, batched=True)
+
+            h_pos = dy.concatenate_cols(pos_encoded)
+            w1dt_pos = self.attention_w1_pos * h_pos
+            bias_pos = dy.inputTensor((1.0 - pos_mask) * -1e9, batched=True)
+
+            entities = [entity for _, _, entity in batch]
+            outputs = self.beam_decode(h_pre, w1dt_pre, h_pos, w1dt_pos, entities, beam, bias_pre, bias_pos)
+            for i, output in zip(order[start:start+size], outputs):
+                results[i] = output
+        return results
+
+
+    def beam_decode(self, h_pre, w1dt_pre, h_pos, w1dt_pos, entities, beam, bias_pre=None, bias_pos=None):
+        """
+        Beam search (search.beam_search) over the encoded contexts of one or more queries, which are the batch
+        elements of h and w1dt (bias masks the padding of batched contexts). The live candidates of all the
+        queries are the batch elements of the decoder state, each of them attending to its own query.
+        :return: candidates of every query, best first
+        """
+        nqueries = len(entities)
+        entity_embeddings = dy.lookup_batch(self.input_lookup, self.input_vocab.encode(entities).tolist())
+        last_output_embeddings = dy.lookup_batch(self.output_lookup, nqueries * [self.output2int[self.EOS]])
+        s = self.dec_lstm.initial_state().add_input(dy.concatenate([dy.zeros(self.config.state_dim*4, batch_size=nqueries), last_output_embeddings, entity_embeddings]))
+        state = [s]
+
+        def decode_step(rows, queries, words):
+            s = state[0].set_s([dy.pick_batch_elems(x, rows) for x in state[0].s()])
+            if nqueries > 1:
+                attention_pre, attention_pos = self.attend_contexts(s, dy.pick_batch_elems(h_pre, queries), dy.pick_batch_elems(w1dt_pre, queries),
+                                                                    dy.pick_batch_elems(h_pos, queries), dy.pick_batch_elems(w1dt_pos, queries),
+                                                                    dy.pick_batch_elems(bias_pre, queries), dy.pick_batch_elems(bias_pos, queries))
+                entity_embedding = dy.pick_batch_elems(entity_embeddings, queries)
+            else:
+                attention_pre, attention_pos = self.attend_contexts(s, h_pre, w1dt_pre, h_pos, w1dt_pos, bias_pre, bias_pos)
+                entity_embedding = entity_embeddings
 
-            output['prob'] /= lp_y
+            last_output_embeddings = dy.lookup_batch(self.output_lookup, words.tolist())
+            vector = dy.concatenate([attention_pre, attention_pos, last_output_embeddings, entity_embedding])
+            state[0] = s.add_input(vector)
+            out_vector = self.decoder_w * state[0].output() + self.decoder_b
+            probs = dy.softmax(out_vector).npvalue().reshape((self.OUTPUT_VOCAB_SIZE, len(rows)))
+            with np.errstate(divide='ignore'):
+                return np.log(probs.T.astype(np.float64))
 
-        outputs = sorted(outputs, key=lambda x: x['prob'], reverse=True)
-        return list(map(lambda x: x['sentence'], outputs))
+        outputs = beam_search(nqueries, beam, self.config.max_len, self.config.early_exit, self.output2int[self.EOS],
+                              self.OUTPUT_VOCAB_SIZE, decode_step)
+        return [[[self.int2output[word] for word in candidate] for candidate in candidates] for candidates in outputs]
 
 
     def get_loss(self, pre_context, pos_context, refex, entity):
@@ -340,6 +539,30 @@ class NeuralREG():
         return self.decode(pre_encoded, pos_encoded, refex, entity)
 
 
+    def get_batch_loss(self, batch):
+        pre_contexts = [[self.EOS] + inst['pre_context'] for inst in batch]
+        pos_contexts = [inst['pos_context'] + [self.EOS] for inst in batch]
+        refexes = [[self.EOS] + inst['refex'] + [self.EOS] for inst in batch]
+        entities = [inst['entity'] for inst in batch]
+
+        pre_mask = self.batch_mask([len(pre_context) for pre_context in pre_contexts])
+        embedded = self.embed_batch(pre_contexts)
+        pre_encoded = self.encode_batch(self.encpre_fwd_lstm, self.encpre_bwd_lstm, embedded, pre_mask)
+
+        pos_mask = self.batch_mask([len(pos_context) for pos_context in pos_contexts])
+        embedded = self.embed_batch(pos_contexts)
+        pos_encoded = self.encode_batch(self.encpos_fwd_lstm, self.encpos_bwd_lstm, embedded, pos_mask)
+
+        return self.decode_batch(pre_encoded, pre_mask, pos_encoded, pos_mask, refexes, entities)
+
+
+    def batches(self, dataset):
+        # instances of similar lengths are put together in the same batch to reduce the padding
+        lengths = lambda inst: (len(inst['pre_context']), len(inst['pos_context']), len(inst['refex']))
+        dataset = sorted(dataset, key=lengths)
+        return [dataset[i:i+self.config.batch] for i in range(0, len(dataset), self.config.batch)]
+
+
     def write(self, fname, outputs):
         f = open(fname, 'w')
         for output in outputs:
@@ -388,28 +611,18 @@ class NeuralREG():
 
         log = []
         best_acc, repeat = 0.0, 0
+        batches = self.batches(self.trainset)
         for epoch in range(self.config.epochs):
+            random.shuffle(batches)
+            for i, batch in enumerate(batches):
+                dy.renew_cg()
+                loss = self.get_batch_loss(batch)
+                closs = loss.value()
+                loss.backward()
+                trainer.update()
+
+                print("Epoch: {0} \t Loss: {1} \t Progress: {2}".format(epoch, (closs / len(batch)), round(i / len(batches), 2)), end='       \r')
             dy.renew_cg()
-            losses = []
-            closs = 0.0
-            for i, traininst in enumerate(self.trainset):
-                pre_context = [self.EOS] + traininst['pre_context']
-                pos_context = traininst['pos_context'] + [self.EOS]
-                refex = [self.EOS] + traininst['refex'] + [self.EOS]
-                entity = traininst['entity']
-                loss = self.get_loss(pre_context, pos_context, refex, entity)
-                losses.append(loss)
-
-                if len(losses) == self.config.batch:
-                    loss = dy.esum(losses)
-                    closs += loss.value()
-                    loss.backward()
-                    trainer.update()
-                    dy.renew_cg()
-
-                    print("Epoch: {0} \t Loss: {1} \t Progress: {2}".format(epoch, (closs / self.config.batch), round(i / len(self.trainset), 2)), end='       \r')
-                    losses = []
-                    closs = 0.0
 
             outputs, num, dem = self.validate()
             acc = float(num) / dem
@@ -477,6 +690,25 @@ class NeuralREG():
         self.model.populate(path)
 
 
+    def export(self, path):
+        """
+        Save the parameters in a numpy .npz file, to be loaded by the numpy inference engine (numpyreg.NumpyREG).
+        The LSTM weights of each layer are saved as <lstm>_<layer>_wx, _wh and _b (gates i, f, o, g)
+        :param path: path of the .npz file
+        """
+        weights = {}
+        for name in ['encpre_fwd_lstm', 'encpre_bwd_lstm', 'encpos_fwd_lstm', 'encpos_bwd_lstm', 'dec_lstm']:
+            for layer, (wx, wh, b) in enumerate(getattr(self, name).get_parameters()):
+                weights['{0}_{1}_wx'.format(name, layer)] = wx.as_array()
+                weights['{0}_{1}_wh'.format(name, layer)] = wh.as_array()
+                weights['{0}_{1}_b'.format(name, layer)] = b.as_array()
+
+        for name in ['input_lookup', 'output_lookup', 'attention_w1_pre', 'attention_w2_pre', 'attention_v_pre',
+                     'attention_w1_pos', 'attention_w2_pos', 'attention_v_pos', 'decoder_w', 'decoder_b']:
+            weights[name] = getattr(self, name).as_array()
+        np.savez(path, **weights)
+
+
 if __name__ == '__main__':
     config = {
         'LSTM_NUM_OF_LAYERS':1,
@@ -0,0 +1,463 @@
+"""
+Description:
+    NumPy inference engine of NeuralREG, which runs a model exported by NeuralREG.export (.npz) without DyNet:
+    bidirectional LSTM encoders of the pre- and pos-contexts, attention over both of them and LSTM decoder,
+    with the greedy and beam searches of neuralreg.NeuralREG, whose outputs are the same without dropout (DROPOUT
+    must be 0.0). The live candidates of the beam, of one or many queries, are decoded together as the rows of
+    the decoder states.
+
+    The largest weights (embedding tables and softmax projection of the decoder) can be quantized to float16 or
+    to int8 with a scale per row (config key QUANTIZATION), which reduces the memory of a model. The other
+    weights are kept in float32.
+
+    NumpyREG(config, path, weights_path)
+        :param config: configuration of neuralreg.NeuralREG (the dimensions are read from the weights)
+        :param path: directory with vocab.json
+        :param weights_path: .npz file exported by NeuralREG.export
+
+        generate(pre_context, pos_context, entity): greedy search
+        beam_search(pre_context, pos_context, entity, beam): candidates, best first
+        batch_beam_search(queries, beam): beam search of (pre_context, pos_context, entity) queries
+        realize_entries(entries, beam): beam search of the mentions of entries, which share their encodings
+        encode_entry(context), realize_mention(encoding, position, entity, beam): mentions of an entry
+
+    PYTHON VERSION: 3
+
+    DEPENDENCIES:
+        NumPy: http://www.numpy.org/
+
+    EXAMPLE:
+        python3 scripts/export_reg.py reg/model1.dy reg/model1.npz
+        python3 reg/generate.py dev.lex.postprocessed dev.ordering.mapped dev.reg numpyreg reg/model1.npz
+        python3 reg/generate.py dev.lex.postprocessed dev.ordering.mapped dev.reg numpyreg_int8 reg/model1.npz
+"""
+
+import json
+import numpy as np
+import os
+
+from model import Config, Vocab
+from search import beam_search, top_k
+
+# forget gate bias of the LSTMs (default of dynet's VanillaLSTMBuilder)
+FORGET_BIAS = 1.0
+
+QUANTIZATIONS = ['float16', 'int8']
+# rows of a quantized matrix dequantized at once to be multiplied
+BLOCK_ROWS = 1024
+
+
+def sigmoid(x):
+    with np.errstate(over='ignore'):
+        return 1.0 / (1.0 + np.exp(-x))
+
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+class LSTM:
+    """
+    Stacked LSTM (dynet's VanillaLSTMBuilder) over a batch of rows. A state is a pair of lists with the cells
+    and the outputs of every layer, each of them a (rows x state dimension) array
+    """
+    def __init__(self, layers):
+        # layers: (wx, wh, b) weights of each layer, with the gates in the order i, f, o, g
+        self.layers = layers
+        self.state_dim = layers[0][1].shape[1]
+
+
+    def initial_state(self, rows=1):
+        zeros = np.zeros((rows, self.state_dim), dtype=np.float32)
+        return len(self.layers) * [zeros], len(self.layers) * [zeros]
+
+
+    def cell(self, state, gates):
+        # new cell and output of a layer from its gate pre-activations
+        dim = self.state_dim
+        i = sigmoid(gates[:, :dim])
+        f = sigmoid(gates[:, dim:2*dim] + FORGET_BIAS)
+        o = sigmoid(gates[:, 2*dim:3*dim])
+        g = np.tanh(gates[:, 3*dim:])
+        c = f * state + i * g
+        return c, o * np.tanh(c)
+
+
+    def add_input(self, state, x, gates=None):
+        """
+        :param gates: optional gate pre-activations added to the ones of the first layer (rows x 4*state)
+        """
+        cells, outputs = [], []
+        for layer, ((wx, wh, b), c, h) in enumerate(zip(self.layers, state[0], state[1])):
+            pre_activations = x @ wx.T + h @ wh.T + b
+            if layer == 0 and gates is not None:
+                pre_activations += gates
+            c, x = self.cell(c, pre_activations)
+            cells.append(c)
+            outputs.append(x)
+        return cells, outputs
+
+
+    def transduce(self, xs):
+        """
+        Outputs of the last layer over a sequence, computed layer by layer: the input projections of a layer are
+        computed at once for the entire sequence, so only the recurrent ones are computed step by step
+        :param xs: inputs of the sequence (seqlen x input dimension)
+        :return: outputs of the sequence (seqlen x state dimension)
+        """
+        for wx, wh, b in self.layers:
+            gates = xs @ wx.T + b
+            c = h = np.zeros((1, self.state_dim), dtype=np.float32)
+            xs = np.zeros((len(gates), self.state_dim), dtype=np.float32)
+            for t in range(len(gates)):
+                c, h = self.cell(c, gates[t:t+1] + h @ wh.T)
+                xs[t] = h[0]
+        return xs
+
+
+    def select(self, state, rows):
+        return [c[rows] for c in state[0]], [h[rows] for h in state[1]]
+
+
+class QuantizedRows:
+    """
+    Matrix quantized row by row: to float16, or to int8 with the scale of each row (its maximum absolute value
+    over 127). Rows are looked up as float32 and the matrix is multiplied block by block, so at most BLOCK_ROWS
+    of its rows are dequantized at a time
+    """
+    def __init__(self, matrix, quantization, block_rows=BLOCK_ROWS):
+        self.block_rows = block_rows
+        if quantization == 'int8':
+            self.scales = np.abs(matrix).max(axis=1) / 127.0
+            self.scales[self.scales == 0.0] = 1.0
+            self.scales = self.scales.astype(np.float32)
+            self.rows = np.round(matrix / self.scales[:, None]).astype(np.int8)
+        elif quantization == 'float16':
+            self.scales = None
+            self.rows = matrix.astype(np.float16)
+        else:
+            raise ValueError('Unknown quantization: {0} (expected one of {1})'.format(quantization, QUANTIZATIONS))
+
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+
+    @property
+    def shape(self):
+        return self.rows.shape
+
+
+    def __len__(self):
+        return len(self.rows)
+
+
+    def __getitem__(self, ids):
+        rows = self.rows[ids].astype(np.float32)
+        if self.scales is not None:
+            rows *= self.scales[ids][..., None]
+        return rows
+
+
+    def project(self, x):
+        # x @ matrix.T, the scale of a row being the one of an output column
+        y = np.empty((len(x), len(self.rows)), dtype=np.float32)
+        for start in range(0, len(self.rows), self.block_rows):
+            end = start + self.block_rows
+            np.matmul(x, self.rows[start:end].astype(np.float32).T, out=y[:, start:end])
+        if self.scales is not None:
+            y *= self.scales
+        return y
+
+
+class NumpyREG():
+    def __init__(self, config, path, weights_path):
+        self.path = path
+        self.config = Config(config=config)
+        if self.config.dropout > 0:
+            # the outputs would differ from the ones of neuralreg.NeuralREG, which applies it
+            raise ValueError('NumpyREG decodes without dropout: set DROPOUT to 0.0')
+
+        self.EOS = "eos"
+        self.vocab = json.load(open(os.path.join(self.path, 'vocab.json')))
+        self.input_vocab = Vocab(self.vocab['input'], self.EOS)
+        self.output_vocab = Vocab(self.vocab['output'], self.EOS)
+
+        weights = np.load(weights_path)
+        self.encpre_fwd_lstm = LSTM(self.lstm_layers(weights, 'encpre_fwd_lstm'))
+        self.encpre_bwd_lstm = LSTM(self.lstm_layers(weights, 'encpre_bwd_lstm'))
+        self.encpos_fwd_lstm = LSTM(self.lstm_layers(weights, 'encpos_fwd_lstm'))
+        self.encpos_bwd_lstm = LSTM(self.lstm_layers(weights, 'encpos_bwd_lstm'))
+        self.dec_lstm = LSTM(self.lstm_layers(weights, 'dec_lstm'))
+
+        # the largest weights are quantized as they are loaded, so their float32 arrays are released one by one
+        self.input_lookup = self.load_rows(weights, 'input_lookup')
+        self.output_lookup = self.load_rows(weights, 'output_lookup')
+
+        self.attention_w1_pre = weights['attention_w1_pre']
+        self.attention_w2_pre = weights['attention_w2_pre']
+        self.attention_v_pre = weights['attention_v_pre'].reshape(-1)
+
+        self.attention_w1_pos = weights['attention_w1_pos']
+        self.attention_w2_pos = weights['attention_w2_pos']
+        self.attention_v_pos = weights['attention_v_pos'].reshape(-1)
+
+        self.decoder_w = self.load_rows(weights, 'decoder_w')
+        self.decoder_b = weights['decoder_b']
+
+        # the inputs of the decoder are [attention_pre; attention_pos; output embedding; entity embedding]. Its
+        # first layer is split by input: the projection of the entity embedding is computed once per query and the
+        # one of the output embeddings of the rows at every step (see output_gates)
+        wx, wh, b = self.dec_lstm.layers[0]
+        attention_dim, embedding_dim = 4 * self.dec_lstm.state_dim, self.output_lookup.shape[1]
+        self.dec_lstm.layers[0] = (np.ascontiguousarray(wx[:, :attention_dim]), wh, b)
+        self.dec_output_w = np.ascontiguousarray(wx[:, attention_dim:attention_dim+embedding_dim])
+        self.dec_entity_w = np.ascontiguousarray(wx[:, attention_dim+embedding_dim:])
+
+
+    def load_rows(self, weights, name):
+        if self.config.quantization is not None:
+            return QuantizedRows(weights[name], self.config.quantization)
+        return weights[name]
+
+
+    def lstm_layers(self, weights, name):
+        layers, layer = [], 0
+        while '{0}_{1}_wx'.format(name, layer) in weights:
+            layers.append(tuple(weights['{0}_{1}_{2}'.format(name, layer, w)] for w in ['wx', 'wh', 'b']))
+            layer += 1
+        return layers
+
+
+    def embed_input(self, ids):
+        return self.input_lookup[ids]
+
+
+    def embed_output(self, ids):
+        return self.output_lookup[ids]
+
+
+    def output_gates(self, words):
+        # projections of the output embeddings of the words by the first layer of the decoder
+        return self.embed_output(words) @ self.dec_output_w.T
+
+
+    def output_scores(self, h):
+        if self.config.quantization is not None:
+            return self.decoder_w.project(h) + self.decoder_b
+        return h @ self.decoder_w.T + self.decoder_b
+
+
+    def nbytes(self):
+        # memory of the weights which may be quantized
+        return sum([x.nbytes for x in [self.input_lookup, self.output_lookup, self.decoder_w]])
+
+
+    def encode_sentence(self, enc_fwd_lstm, enc_bwd_lstm, sentence, attention_w1):
+        """
+        :return: encoder states (seqlen x 2*state) and their attention keys (seqlen x attention)
+        """
+        embedded = self.embed_input(self.input_vocab.encode(sentence))
+        fwd_vectors = enc_fwd_lstm.transduce(embedded)
+        # (reversed views are not multiplied by BLAS)
+        bwd_vectors = enc_bwd_lstm.transduce(np.ascontiguousarray(embedded[::-1]))[::-1]
+        h = np.concatenate([fwd_vectors, bwd_vectors], axis=1)
+        return h, h @ attention_w1.T
+
+
+    def encode_batch(self, enc_fwd_lstm, enc_bwd_lstm, sentences, attention_w1):
+        """
+        Encode the sentences of a batch, padded to the longest one
+        :return: encoder states (batch x seqlen x 2*state), attention keys (batch x seqlen x attention) and
+        attention bias (batch x seqlen), which masks the padding
+        """
+        return self.pad([self.encode_sentence(enc_fwd_lstm, enc_bwd_lstm, sentence, attention_w1) for sentence in sentences])
+
+
+    def pad(self, encoded):
+        # batch of (encoder states, attention keys) pairs, padded to the longest sentence (see encode_batch)
+        seqlen = max([len(sentence_h) for sentence_h, _ in encoded])
+        h = np.zeros((len(encoded), seqlen, encoded[0][0].shape[1]), dtype=np.float32)
+        w1dt = np.zeros((len(encoded), seqlen, encoded[0][1].shape[1]), dtype=np.float32)
+        bias = np.full((len(encoded), seqlen), -1e9, dtype=np.float32)
+        for i, (sentence_h, sentence_w1dt) in enumerate(encoded):
+            h[i, :len(sentence_h)] = sentence_h
+            w1dt[i, :len(sentence_h)] = sentence_w1dt
+            bias[i, :len(sentence_h)] = 0.0
+        return h, w1dt, bias
+
+
+    def attend(self, encoded, w2dt, attention_v):
+        # encoded: encoder states, attention keys and bias of each row, w2dt: (rows x attention)
+        h, w1dt, bias = encoded
+        att_weights = softmax(np.tanh(w1dt + w2dt[:, None, :]) @ attention_v + bias)
+        return np.matmul(att_weights[:, None, :], h)[:, 0]
+
+
+    def decode_step(self, state, pre_encoded, pos_encoded, words, entity_gates):
+        """
+        Decode the next words of a batch of rows
+        :param state: decoder state of the rows
+        :param pre_encoded, pos_encoded: encoded contexts of the rows (see encode_batch)
+        :param words: last words of the rows
+        :param entity_gates: projections of the entity embeddings of the rows by the decoder (see encode)
+        :return: next decoder state and probabilities of the next words (rows x output vocabulary)
+        """
+        s = np.concatenate(state[0] + state[1], axis=1)
+        attention_pre = self.attend(pre_encoded, s @ self.attention_w2_pre.T, self.attention_v_pre)
+        attention_pos = self.attend(pos_encoded, s @ self.attention_w2_pos.T, self.attention_v_pos)
+
+        vector = np.concatenate([attention_pre, attention_pos], axis=1)
+        state = self.dec_lstm.add_input(state, vector, self.output_gates(words) + entity_gates)
+        return state, softmax(self.output_scores(state[1][-1]))
+
+
+    def encode(self, queries):
+        pre_encoded = self.encode_batch(self.encpre_fwd_lstm, self.encpre_bwd_lstm, [query[0] for query in queries], self.attention_w1_pre)
+        pos_encoded = self.encode_batch(self.encpos_fwd_lstm, self.encpos_bwd_lstm, [query[1] for query in queries], self.attention_w1_pos)
+        return pre_encoded, pos_encoded, self.entity_gates([query[2] for query in queries])
+
+
+    def entity_gates(self, entities):
+        # projections of the entity embeddings by the first layer of the decoder
+        return self.embed_input(self.input_vocab.encode(entities)) @ self.dec_entity_w.T
+
+
+    def start(self, entity_gates):
+        # decoder state of each query after its first input (eos), without attention contexts
+        rows = len(entity_gates)
+        vector = np.zeros((rows, self.dec_lstm.state_dim*4), dtype=np.float32)
+        gates = self.output_gates(np.full(rows, self.output_vocab[self.EOS])) + entity_gates
+        return self.dec_lstm.add_input(self.dec_lstm.initial_state(rows), vector, gates)
+
+
+    def generate(self, pre_context, pos_context, entity):
+        pre_encoded, pos_encoded, entity_gates = self.encode([(pre_context, pos_context, entity)])
+        state = self.start(entity_gates)
+
+        eos = self.output_vocab[self.EOS]
+        out = []
+        count_EOS = 0
+        next_word = eos
+        for i in range(self.config.max_len):
+            if count_EOS == 2: break
+            state, probs = self.decode_step(state, pre_encoded, pos_encoded, np.array([next_word]), entity_gates)
+            next_word = int(top_k(probs[0], 1)[0])
+            if next_word == eos:
+                count_EOS += 1
+                continue
+
+            out.append(self.output_vocab.int2word[next_word])
+
+        return out
+
+
+    def beam_search(self, pre_context, pos_context, entity, beam):
+        return self.beam_decode(*self.encode([(pre_context, pos_context, entity)]), beam)[0]
+
+
+    def batch_beam_search(self, queries, beam):
+        """
+        Beam search over many queries at once. Queries with similar context lengths are decoded together.
+        :param queries: list of (pre_context, pos_context, entity) tuples
+        :param beam: beam size
+        :return: candidates of every query (as returned by beam_search), in the order of the queries
+        """
+        size = self.config.decode_batch
+        order = sorted(range(len(queries)), key=lambda i: (len(queries[i][0]), len(queries[i][1])))
+
+        results = len(queries) * [None]
+        for start in range(0, len(order), size):
+            print('Progress: ', round(start / len(order), 2), end='\r')
+            outputs = self.beam_decode(*self.encode([queries[i] for i in order[start:start+size]]), beam)
+            for i, output in zip(order[start:start+size], outputs):
+                results[i] = output
+        return results
+
+
+    def beam_decode(self, pre_encoded, pos_encoded, entity_gates, beam):
+        """
+        Beam search (search.beam_search) of encoded queries (see encode): the live candidates of all the queries
+        are the rows of the decoder state, each of them attending to its own query.
+        :return: candidates of every query, best first
+        """
+        state = [self.start(entity_gates)]
+
+        def decode_step(rows, queries, words):
+            state[0], probs = self.decode_step(self.dec_lstm.select(state[0], rows), [x[queries] for x in pre_encoded],
+                                               [x[queries] for x in pos_encoded], words, entity_gates[queries])
+            with np.errstate(divide='ignore'):
+                return np.log(probs.astype(np.float64))
+
+        outputs = beam_search(len(entity_gates), beam, self.config.max_len, self.config.early_exit, self.output_vocab[self.EOS],
+                              len(self.output_vocab), decode_step)
+        return [[[self.output_vocab.int2word[word] for word in candidate] for candidate in candidates] for candidates in outputs]
+
+
+    def encode_entry(self, context):
+        """
+        Encoding shared by the mentions of an entry (see NeuralREG.encode_entry): the forward states of the
+        pre-contexts (prefixes of the context) and the backward states of the pos-contexts (suffixes), with their
+        attention projections, are computed once
+        :param context: tokens of the entry between eos symbols, with the entity names in place of the mentions
+        :return: encoding to be used by encode_mention
+        """
+        state_dim = self.encpre_fwd_lstm.state_dim
+        embedded = self.embed_input(self.input_vocab.encode(context))
+        pre_fwd = self.encpre_fwd_lstm.transduce(embedded[:-1])
+        pos_bwd = self.encpos_bwd_lstm.transduce(np.ascontiguousarray(embedded[:0:-1]))[::-1]
+        return {
+            'embedded': embedded,
+            'pre_fwd': pre_fwd,
+            'pos_bwd': pos_bwd,
+            'w1dt_pre_fwd': pre_fwd @ self.attention_w1_pre[:, :state_dim].T,
+            'w1dt_pos_bwd': pos_bwd @ self.attention_w1_pos[:, state_dim:].T
+        }
+
+
+    def encode_mention(self, encoding, position):
+        """
+        Encoded pre- and pos-contexts of the mention at a position of an entry: only the backward states of the
+        pre-context and the forward states of the pos-context are computed
+        :return: (encoder states, attention keys) of the pre- and of the pos-context (see encode_sentence)
+        """
+        state_dim = self.encpre_fwd_lstm.state_dim
+        embedded = encoding['embedded']
+
+        pre_bwd = self.encpre_bwd_lstm.transduce(np.ascontiguousarray(embedded[position-1::-1]))[::-1]
+        h_pre = np.concatenate([encoding['pre_fwd'][:position], pre_bwd], axis=1)
+        w1dt_pre = encoding['w1dt_pre_fwd'][:position] + pre_bwd @ self.attention_w1_pre[:, state_dim:].T
+
+        pos_fwd = self.encpos_fwd_lstm.transduce(embedded[position+1:])
+        h_pos = np.concatenate([pos_fwd, encoding['pos_bwd'][position:]], axis=1)
+        w1dt_pos = pos_fwd @ self.attention_w1_pos[:, :state_dim].T + encoding['w1dt_pos_bwd'][position:]
+        return (h_pre, w1dt_pre), (h_pos, w1dt_pos)
+
+
+    def realize_entries(self, entries, beam):
+        """
+        Beam search of the mentions of many entries (see NeuralREG.realize_entries). The encoding of an entry is
+        shared by its mentions, which are decoded together in batches of DECODE_BATCH mentions.
+        :param entries: list of (context, positions) tuples, positions being the indices of the mentions in the context
+        :return: candidates of every mention (as returned by beam_search), by entry
+        """
+        mentions = []
+        for context, positions in entries:
+            if len(positions) == 0:
+                continue
+            encoding = self.encode_entry(context)
+            mentions.extend([(self.encode_mention(encoding, position), context[position]) for position in positions])
+
+        size = self.config.decode_batch
+        outputs = []
+        for start in range(0, len(mentions), size):
+            print('Progress: ', round(start / len(mentions), 2), end='\r')
+            batch = mentions[start:start+size]
+            pre_encoded = self.pad([pre for (pre, _), _ in batch])
+            pos_encoded = self.pad([pos for (_, pos), _ in batch])
+            outputs.extend(self.beam_decode(pre_encoded, pos_encoded, self.entity_gates([entity for _, entity in batch]), beam))
+
+        outputs = iter(outputs)
+        return [[next(outputs) for _ in positions] for _, positions in entries]
@@ -10,9 +10,14 @@ Description:
         [1] Path to the folder where WebNLG corpus is available (versions/v1.4/en)
         [2] Path to the folder where the data will be saved (Folder will be created in case it does not exist)
         [3] Path to the stanford parser (which can be downloaded here: https://stanfordnlp.github.io/CoreNLP/)
+        [4] Optional annotation backend: corenlp (default) or replay (cached annotations only, no CoreNLP server)
+
+    ENVIRONMENT:
+        DEEPNLG_WORKERS: optional number of processes parsing the corpus files (1 by default)
 
     EXAMPLE:
         python3 preprocess.py ../versions/v1.4/en reg/ stanford_path/
+        DEEPNLG_WORKERS=8 python3 preprocess.py ../versions/v1.4/en reg/ stanford_path/
 """
 
 import sys
@@ -24,18 +29,20 @@ import json
 import os
 import parsing as parser
 import re
+from annotation import AnnotationMissing
 from lexicalization.preprocess import TemplateExtraction
-from stanfordcorenlp import StanfordCoreNLP
 
 STANFORD_PATH=r'/home/tcastrof/workspace/stanford/stanford-corenlp-full-2018-02-27'
+ANNOTATOR = 'corenlp'
 
 class REGPrec:
     def __init__(self, data_path, write_path):
         self.data_path = data_path
         self.write_path = write_path
 
-        self.temp_extractor = TemplateExtraction()
-        self.corenlp = StanfordCoreNLP(STANFORD_PATH)
+        self.temp_extractor = TemplateExtraction(stanford_path=STANFORD_PATH, annotator=ANNOTATOR)
+        # annotations share the connection (and cache) of the template extractor
+        self.corenlp = self.temp_extractor.corenlp
         self.traindata, self.vocab = self.process(entry_path=os.path.join(data_path, 'train'))
 
 
@@ -63,6 +70,8 @@ class REGPrec:
             for snt in out['sentences']:
                 sentence = list(map(lambda w: w['originalText'], snt['tokens']))
                 tokens.extend(sentence)
+        except AnnotationMissing:
+            raise
         except:
             print('Parsing error...')
 
@@ -70,7 +79,7 @@ class REGPrec:
 
 
     def process(self, entry_path):
-        entryset = parser.run_parser(entry_path)
+        entryset = parser.run_cached_parser(entry_path)
 
         data, size = [], 0
         invocab, outvocab = [], []
@@ -153,5 +162,7 @@ if __name__ == '__main__':
     data_path = sys.argv[1]
     write_path = sys.argv[2]
     STANFORD_PATH = sys.argv[3]
+    if len(sys.argv) > 4:
+        ANNOTATOR = sys.argv[4]
     s = REGPrec(data_path=data_path, write_path=write_path)
 
@@ -0,0 +1,177 @@
+"""
+Description:
+    Search utilities of the REG decoders, on numpy arrays only (no DyNet).
+
+    top_k(scores, k): indices of the k highest scores, best first, ties broken by the lowest index
+    length_penalty(length): length normalization of the scores of the beam search outputs
+    Hypotheses(start): beam hypotheses stored as back-pointers, whose token sequences are only built at the end
+    beam_search(nqueries, beam, max_len, early_exit, eos, vocab_size, decode_step): beam search of the REG decoders,
+        which only supply the decoding step
+
+    PYTHON VERSION: 3
+
+    DEPENDENCIES:
+        NumPy: http://www.numpy.org/
+"""
+
+import numpy as np
+
+
+def top_k(scores, k):
+    """
+    Indices of the k highest scores, best first, without sorting the whole array: the k-th highest score is
+    found by partitioning and only the indices above or tied with it are sorted. Ties are broken by the lowest
+    index, as a stable sort would do.
+    :param scores: 1-d numpy array
+    :param k: number of indices
+    :return: numpy array of indices
+    """
+    k = min(k, len(scores))
+    kth = -np.partition(-scores, k-1)[k-1]
+    above = np.flatnonzero(scores > kth)
+    tied = np.flatnonzero(scores == kth)[:k-len(above)]
+    best = np.concatenate([above, tied])
+    return best[np.lexsort((best, -scores[best]))]
+
+
+def length_penalty(length):
+    # Length Normalization
+    alpha = 0.6
+    return ((5.0 + length)**alpha) / ((5.0+1.0)**alpha)
+
+
+class Hypotheses:
+    """
+    Hypotheses of a beam search, stored step by step as back-pointers: hypothesis j of step i has the token
+    tokens[i][j] and continues the hypothesis parents[i][j] of step i-1. Extending the beam does not copy the
+    prefixes of the hypotheses, which are only followed back when their sequences are needed.
+    """
+    def __init__(self, start):
+        # step 0: a single hypothesis with the start token
+        self.tokens = [np.array([start])]
+        self.parents = [np.array([-1])]
+
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+    def extend(self, parents, tokens):
+        """
+        Add a step to the hypotheses
+        :param parents: indices of the continued hypotheses in the last step
+        :param tokens: tokens which continue them
+        """
+        self.parents.append(np.asarray(parents))
+        self.tokens.append(np.asarray(tokens))
+
+
+    def last(self):
+        # last tokens of the hypotheses of the last step
+        return self.tokens[-1]
+
+
+    def sequence(self, step, index):
+        """
+        :param step: step of the hypothesis
+        :param index: index of the hypothesis in its step
+        :return: tokens of the hypothesis, from the start token on
+        """
+        tokens = []
+        while step >= 0:
+            tokens.append(int(self.tokens[step][index]))
+            index = self.parents[step][index]
+            step -= 1
+        return tokens[::-1]
+
+
+def beam_search(nqueries, beam, max_len, early_exit, eos, vocab_size, decode_step):
+    """
+    Beam search over one or more queries. The live candidates of all the queries are expanded at once: they are
+    the rows of the decoder state, which is kept by the decoder and reordered by decode_step.
+    :param nqueries: number of queries, which are the rows of the initial decoder state
+    :param beam: beam size
+    :param max_len: maximum number of steps
+    :param early_exit: stop the search of a query once none of its live candidates can beat its best finished one
+        after length normalization
+    :param eos: id of the eos token, which starts the candidates and finishes them at its second occurrence
+    :param vocab_size: size of the output vocabulary
+    :param decode_step: function (rows, queries, words) -> log-probabilities (len(rows) x vocab_size) of the next words,
+        which continues the rows of the decoder state with the last words of the candidates and keeps the new
+        state. queries are the queries of the rows.
+    :return: token ids of the candidates of every query, best first
+    """
+    # candidates of each query are ordered by probability and kept as back-pointers (Hypotheses) with their
+    # scores and numbers of eos. Candidate j of a query continues the row parents[query][j] of the decoder state
+    hypotheses = [Hypotheses(eos) for _ in range(nqueries)]
+    scores = [np.zeros(1) for _ in range(nqueries)]
+    count_EOS = [np.zeros(1, dtype=int) for _ in range(nqueries)]
+    parents = [[query] for query in range(nqueries)]
+    # outputs: (score, step, index) of the finished candidates
+    outputs = [[] for _ in range(nqueries)]
+    finished = nqueries * [False]
+
+    i = 0
+    while i < max_len:
+        # live: (query, candidate) pairs, grouped by query
+        live = []
+        for query in range(nqueries):
+            if finished[query]:
+                continue
+
+            query_live = []
+            for j in range(len(scores[query])):
+                if count_EOS[query][j] == 2:
+                    outputs[query].append((scores[query][j], len(hypotheses[query]) - 1, j))
+
+                    if len(outputs[query]) == beam: break
+                else:
+                    query_live.append(j)
+
+            if len(outputs[query]) == beam or len(query_live) == 0:
+                finished[query] = True
+            elif early_exit and len(outputs[query]) > 0:
+                # log-probabilities only decrease as a candidate grows, whereas the length penalty is at most
+                # the one of max_len: the normalized score of a live candidate cannot exceed this bound
+                bound = scores[query][query_live].max() / length_penalty(max_len + 1)
+                if bound < max([prob / length_penalty(step + 1) for prob, step, _ in outputs[query]]):
+                    finished[query] = True
+                else:
+                    live.extend([(query, j) for j in query_live])
+            else:
+                live.extend([(query, j) for j in query_live])
+        if len(live) == 0: break
+
+        # all the live candidates are expanded at once
+        rows = [parents[query][j] for query, j in live]
+        words = np.array([hypotheses[query].last()[j] for query, j in live])
+        logprobs = decode_step(rows, [query for query, _ in live], words)
+
+        query_rows = {}
+        for row, (query, j) in enumerate(live):
+            query_rows.setdefault(query, []).append(row)
+
+        for query, rows in query_rows.items():
+            candidates = np.array([live[row][1] for row in rows])
+            # top candidates by probability, ties broken by the order of the candidates and then of the words
+            query_scores = (scores[query][candidates][:, None] + logprobs[rows[0]:rows[-1]+1]).ravel()
+            best = top_k(query_scores, beam)
+            parent, word = np.divmod(best, vocab_size)
+
+            hypotheses[query].extend(candidates[parent], word)
+            scores[query] = query_scores[best]
+            count_EOS[query] = count_EOS[query][candidates[parent]] + (word == eos)
+            parents[query] = [rows[j] for j in parent]
+        i += 1
+
+    results = []
+    for query in range(nqueries):
+        if len(outputs[query]) == 0:
+            outputs[query] = [(scores[query][j], len(hypotheses[query]) - 1, j) for j in range(len(scores[query]))]
+
+        # Length Normalization
+        normalized = [(prob / length_penalty(step + 1), step, j) for prob, step, j in outputs[query]]
+
+        normalized = sorted(normalized, key=lambda x: x[0], reverse=True)
+        results.append([hypotheses[query].sequence(step, j) for _, step, j in normalized])
+    return results
@@ -0,0 +1,122 @@
+"""
+Description:
+    Step-level benchmark of the NeuralREG decoder attention. The former attention of NeuralREG, which builds the
+    decoder state separately for the pre- and pos-contexts (legacy_attend), is compared against the one shared by
+    both contexts (NeuralREG.attend_contexts). The keys of both are projected once per encoding. Every decoding
+    step is timed from the construction of its attention to the forward pass of the attention contexts and of
+    the output scores, and the scores of both attentions are checked to be the same.
+
+    Without a trained model, the parameters are randomly initialized.
+
+    ARGS:
+        [1] Path to the REG data (folder with vocab.json)
+        [2] Optional path to a trained model
+        [3] Optional number of decoding steps (100 by default)
+
+    EXAMPLE:
+        python3 scripts/benchmark_attention.py evaluation/data/reg reg/model1.dy 200
+"""
+
+import sys
+sys.path.append('./')
+sys.path.append('../')
+sys.path.append('./reg')
+sys.path.append('../reg')
+
+import dynet as dy
+import numpy as np
+import random
+import time
+
+from neuralreg import NeuralREG
+
+CONFIG = {
+    'LSTM_NUM_OF_LAYERS':1,
+    'EMBEDDINGS_SIZE':300,
+    'STATE_SIZE':512,
+    'ATTENTION_SIZE':512,
+    'DROPOUT':0.0,
+    'GENERATION':30,
+    'BEAM_SIZE':5,
+    'BATCH_SIZE': 80,
+    'EPOCHS': 60,
+    'EARLY_STOP': 10
+}
+CONTEXT_SIZE = 20
+
+
+def legacy_attend(model, h, state, w1dt, attention_w2, attention_v):
+    # input_mat: (encoder_state x seqlen) => input vecs concatenated as cols
+    # w1dt: (attdim x seqlen)
+    # w2dt: (attdim x attdim)
+    w2dt = attention_w2*dy.concatenate(list(state.s()))
+    return model.attention_context(h, w1dt, w2dt, attention_v)
+
+
+def separate(model, s, h_pre, w1dt_pre, h_pos, w1dt_pos):
+    attention_pre = legacy_attend(model, h_pre, s, w1dt_pre, model.attention_w2_pre, model.attention_v_pre)
+    attention_pos = legacy_attend(model, h_pos, s, w1dt_pos, model.attention_w2_pos, model.attention_v_pos)
+    return attention_pre, attention_pos
+
+
+def shared(model, s, h_pre, w1dt_pre, h_pos, w1dt_pos):
+    return model.attend_contexts(s, h_pre, w1dt_pre, h_pos, w1dt_pos)
+
+
+def measure(model, attention, pre_context, pos_context, entity, steps):
+    dy.renew_cg()
+    h_pre = dy.concatenate_cols(model.encode_sentence(model.encpre_fwd_lstm, model.encpre_bwd_lstm, model.embed_sentence(pre_context)))
+    h_pos = dy.concatenate_cols(model.encode_sentence(model.encpos_fwd_lstm, model.encpos_bwd_lstm, model.embed_sentence(pos_context)))
+    w1dt_pre, w1dt_pos = model.attention_w1_pre * h_pre, model.attention_w1_pos * h_pos
+    w1dt_pos.forward()
+
+    entity_embedding = model.input_lookup[model.input_vocab.get(entity)]
+    last_output_embeddings = model.output_lookup[model.output_vocab[model.EOS]]
+    s = model.dec_lstm.initial_state().add_input(dy.concatenate([dy.vecInput(model.config.state_dim*4), last_output_embeddings, entity_embedding]))
+    s.output().forward()
+
+    attention_time, step_time, scores = [], [], []
+    for i in range(steps):
+        start = time.perf_counter()
+        attention_pre, attention_pos = attention(model, s, h_pre, w1dt_pre, h_pos, w1dt_pos)
+        vector = dy.concatenate([attention_pre, attention_pos, last_output_embeddings, entity_embedding])
+        vector.forward()
+        attention_time.append(time.perf_counter() - start)
+
+        s = s.add_input(vector)
+        out_vector = model.decoder_w * s.output() + model.decoder_b
+        scores.append(out_vector.npvalue())
+        step_time.append(time.perf_counter() - start)
+
+        last_output_embeddings = model.output_lookup[int(np.argmax(scores[-1]))]
+    return attention_time, step_time, scores
+
+
+if __name__ == '__main__':
+    path = sys.argv[1]
+    model_path = sys.argv[2] if len(sys.argv) > 2 else None
+    steps = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+
+    model = NeuralREG(config=CONFIG, path=path)
+    if model_path:
+        model.populate(model_path)
+
+    random.seed(0)
+    words = model.input_vocab.int2word
+    pre_context = [model.EOS] + random.sample(words, CONTEXT_SIZE)
+    pos_context = random.sample(words, CONTEXT_SIZE) + [model.EOS]
+    entity = random.choice(words)
+
+    results = {}
+    for name, attention in [('separate', separate), ('shared', shared)]:
+        # a first run warms up the memory pools of dynet
+        measure(model, attention, pre_context, pos_context, entity, steps)
+        results[name] = measure(model, attention, pre_context, pos_context, entity, steps)
+
+    if not all([np.allclose(x, y, atol=1e-5) for x, y in zip(results['separate'][2], results['shared'][2])]):
+        print('Different scores')
+
+    for name in ['separate', 'shared']:
+        attention_time, step_time = np.array(results[name][0]) * 1000, np.array(results[name][1]) * 1000
+        print('{0} \t Attention: {1}ms \t Step: {2}ms (median)'.format(name, round(float(np.median(attention_time)), 3), round(float(np.median(step_time)), 3)))
+    print('Speedup (step): {0}x'.format(round(sum(results['separate'][1]) / sum(results['shared'][1]), 2)))
@@ -0,0 +1,78 @@
+"""
+Description:
+    Benchmark of the xml writer used by parsing.generate (parsing.write_xml) against the former serialization,
+    which dumped the tree with ElementTree, removed the indentation with a regex and pretty-printed the
+    document again with minidom. Both outputs are checked to be identical.
+
+    ARGS:
+        [1] Path to the folder of a WebNLG split (e.g., versions/v1.4/en/train)
+
+    EXAMPLE:
+        python3 scripts/benchmark_generate.py versions/v1.4/en/train
+"""
+
+import sys
+sys.path.append('./')
+sys.path.append('../')
+
+import io
+import os
+import parsing
+import re
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+from xml.dom import minidom
+
+
+def minidom_write(root, f):
+    rough_string = ET.tostring(root, encoding='utf-8', method='xml')
+    rough_string = re.sub(">\n[\t]+<", '><', rough_string.decode('utf-8'))
+    xml = minidom.parseString(rough_string).toprettyxml(indent="\t")
+    f.write(xml)
+
+
+def measure(write, root):
+    # outputs are discarded, so only the memory taken by the serialization itself is measured
+    with open(os.devnull, 'w', encoding='utf-8', newline='') as f:
+        tracemalloc.start()
+        start = time.perf_counter()
+        write(root, f)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def same_output(root):
+    old, new = io.StringIO(), io.StringIO()
+    minidom_write(root, old)
+    parsing.write_xml(root, new)
+    return old.getvalue() == new.getvalue()
+
+
+if __name__ == '__main__':
+    set_path = sys.argv[1]
+
+    entryset = parsing.run_parser(set_path)
+    index = parsing.entry_index(entryset)
+
+    results = { 'minidom': [0.0, 0], 'stream': [0.0, 0] }
+    for fname in parsing.corpus_files(set_path):
+        root = parsing.generate_tree(entryset, fname, 'en', index=index).getroot()
+
+        elapsed, peak = measure(minidom_write, root)
+        results['minidom'][0] += elapsed
+        results['minidom'][1] = max(results['minidom'][1], peak)
+
+        elapsed, peak = measure(parsing.write_xml, root)
+        results['stream'][0] += elapsed
+        results['stream'][1] = max(results['stream'][1], peak)
+
+        if not same_output(root):
+            print('Different output:', fname)
+
+    for method in ['minidom', 'stream']:
+        elapsed, peak = results[method]
+        print('{0} \t Time: {1}s \t Peak memory (largest file): {2}MB'.format(method, round(elapsed, 2), round(peak / 1e6, 2)))
+    print('Speedup: {0}x'.format(round(results['minidom'][0] / results['stream'][0], 1)))
@@ -0,0 +1,95 @@
+"""
+Description:
+    Benchmark of the candidate selection in a step of the NeuralREG beam search, on random softmax outputs of
+    growing vocabulary sizes (numpy only, no model needed). The former selection, which sorted the python list
+    of probabilities of every candidate, looked up the selected words with list.index and accumulated the
+    log-probabilities in python floats, is compared against search.top_k on the numpy scores of all the
+    candidates. The selections of top_k are checked against a stable sort of the scores, with and without ties in
+    the probabilities, and the steps in which list.index made the former selection repeat a candidate are counted.
+
+    ARGS:
+        [1] Optional beam size (5 by default)
+        [2] Optional number of steps per vocabulary size (200 by default)
+
+    EXAMPLE:
+        python3 scripts/benchmark_topk.py 5 200
+"""
+
+import sys
+sys.path.append('./')
+sys.path.append('../')
+sys.path.append('./reg')
+sys.path.append('../reg')
+
+import numpy as np
+import time
+
+from search import top_k
+
+VOCAB_SIZES = [1000, 5000, 20000, 50000]
+
+
+def legacy_step(probs, prefix, beam):
+    # selection of the former beam search: (score, index in the flattened scores) of the next candidates
+    new_candidates = []
+    for parent, (candidate, candidate_probs) in enumerate(zip(prefix, probs)):
+        candidate_probs = candidate_probs.tolist()
+        next_words = [{'prob':e, 'index':candidate_probs.index(e)} for e in sorted(candidate_probs, reverse=True)[:beam]]
+        for next_word in next_words:
+            new_candidates.append((candidate + np.log(next_word['prob']), parent * len(candidate_probs) + next_word['index']))
+    return sorted(new_candidates, key=lambda x: x[0], reverse=True)[:beam]
+
+
+def top_k_step(probs, prefix, beam):
+    with np.errstate(divide='ignore'):
+        scores = (prefix[:, None] + np.log(probs.astype(np.float64))).ravel()
+    best = top_k(scores, beam)
+    return [(scores[index], index) for index in best]
+
+
+def reference_step(probs, prefix, beam):
+    with np.errstate(divide='ignore'):
+        scores = (prefix[:, None] + np.log(probs.astype(np.float64))).ravel()
+    best = np.argsort(-scores, kind='stable')[:beam]
+    return [(scores[index], index) for index in best]
+
+
+def random_step(rng, vocab_size, beam, ties):
+    logits = rng.normal(size=(beam, vocab_size))
+    if ties:
+        logits = np.round(logits)
+    probs = np.exp(logits)
+    probs = (probs / probs.sum(axis=1, keepdims=True)).astype(np.float32)
+    prefix = np.sort(np.log(rng.uniform(size=beam)))[::-1]
+    return probs, prefix
+
+
+def measure(select, steps, beam):
+    start = time.perf_counter()
+    for probs, prefix in steps:
+        select(probs, prefix, beam)
+    return (time.perf_counter() - start) / len(steps)
+
+
+if __name__ == '__main__':
+    beam = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    nsteps = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    rng = np.random.RandomState(0)
+    for vocab_size in VOCAB_SIZES:
+        steps = [random_step(rng, vocab_size, beam, ties=False) for _ in range(nsteps)]
+        tied_steps = [random_step(rng, vocab_size, beam, ties=True) for _ in range(nsteps)]
+
+        for probs, prefix in steps + tied_steps:
+            if [index for _, index in top_k_step(probs, prefix, beam)] != [index for _, index in reference_step(probs, prefix, beam)]:
+                print('Different selection: vocabulary size', vocab_size)
+                break
+        repeated = 0
+        for probs, prefix in tied_steps:
+            selection = [index for _, index in legacy_step(probs, prefix, beam)]
+            repeated += len(set(selection)) < len(selection)
+
+        legacy_time = measure(legacy_step, steps, beam)
+        time_ = measure(top_k_step, steps, beam)
+        print('Vocabulary: {0} \t legacy: {1}ms \t top_k: {2}ms \t Speedup: {3}x \t Legacy repeated candidates with ties: {4}/{5}'.format(
+            vocab_size, round(legacy_time * 1000, 3), round(time_ * 1000, 3), round(legacy_time / time_, 1), repeated, nsteps))
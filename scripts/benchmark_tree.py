@@ -0,0 +1,149 @@
+"""
+Description:
+    Micro-benchmark of the constituency trees used to group verbs in the template extraction
+    (lexicalization.preprocess.Tree). The former implementation, which searched the tree for every
+    verb_parent query, is compared against the current one on the parse trees of the training templates.
+    Both implementations are checked to give the same answers.
+
+    The parse trees are read with the annotation backends (see annotation.py), by default from the cache
+    filled by a previous run of the lexicalization preprocessing.
+
+    ARGS:
+        [1] Path to the folder of the training split (e.g., versions/v1.4/en/train)
+        [2] Optional annotation backend: replay (default) or corenlp
+        [3] Optional path to the stanford parser (only needed by the corenlp backend)
+
+    EXAMPLE:
+        python3 scripts/benchmark_tree.py versions/v1.4/en/train
+"""
+
+import sys
+sys.path.append('./')
+sys.path.append('../')
+
+import copy
+import parsing
+import time
+
+from lexicalization.preprocess import TemplateExtraction, Tree
+
+
+class LegacyTree(Tree):
+    def parse(self, tree):
+        tree = tree.replace('\n', '').replace('(ROOT', '')[:-1]
+        nodes, edges, root = {}, {}, 1
+        node_id = 1
+        prev_id = 0
+        terminalidx = 0
+
+        for child in tree.split():
+            closing = list(filter(lambda x: x == ')', child))
+            if child[0] == '(':
+                nodes[node_id] = {
+                    'id': node_id,
+                    'name': child[1:],
+                    'parent': prev_id,
+                    'type': 'nonterminal',
+                }
+                edges[node_id] = []
+
+                if prev_id > 0:
+                    edges[prev_id].append(node_id)
+                prev_id = copy.copy(node_id)
+            else:
+                terminal = child.replace(')', '')
+                nodes[prev_id]['type'] = 'preterminal'
+
+                try:
+                    lemma = self.token2lemma[terminal]
+                except:
+                    lemma = ''
+
+                nodes[node_id] = {
+                    'id': node_id,
+                    'name': terminal,
+                    'parent': prev_id,
+                    'type': 'terminal',
+                    'idx': terminalidx,
+                    'lemma': lemma
+                }
+
+                terminalidx += 1
+                edges[node_id] = []
+                edges[prev_id].append(node_id)
+
+            node_id += 1
+            for i in range(len(closing)):
+                prev_id = nodes[prev_id]['parent']
+
+        return nodes, edges, root, {}
+
+
+    def verb_parent(self, terminalidx):
+        def search(root):
+            parent = self.nodes[root]['parent']
+            if self.nodes[parent]['name'] == 'VP':
+                return search(parent)
+            return root
+
+        terminal_node = -1
+        for node in self.nodes:
+            type = self.nodes[node]['type']
+            if type == 'terminal':
+                if terminalidx == self.nodes[node]['idx']:
+                    terminal_node = node
+                    break
+        return search(self.nodes[terminal_node]['parent'])
+
+
+def verb_groups(tree_class, snt):
+    # verb_parent queries of TemplateExtraction.delexicalize, None for the trees which cannot be read
+    try:
+        tree = tree_class(tree=snt['parse'], tokens=[], lemmas=[])
+    except:
+        return None
+    verbs = [i for i, token in enumerate(snt['tokens']) if 'VB' in token['pos']]
+    groups = []
+    for prev, i in zip(verbs, verbs[1:]):
+        try:
+            groups.append(tree.verb_parent(i) == tree.verb_parent(prev))
+        except KeyError:
+            groups.append(None)
+    return groups
+
+
+def measure(tree_class, sentences):
+    start = time.perf_counter()
+    groups = [verb_groups(tree_class, snt) for snt in sentences]
+    return time.perf_counter() - start, groups
+
+
+if __name__ == '__main__':
+    set_path = sys.argv[1]
+    annotator = sys.argv[2] if len(sys.argv) > 2 else 'replay'
+    stanford_path = sys.argv[3] if len(sys.argv) > 3 else None
+
+    entryset = parsing.run_cached_parser(set_path)
+    templates = list(dict.fromkeys([lex.template for entry in entryset for lex in entry.lexEntries]))
+
+    extractor = TemplateExtraction(stanford_path=stanford_path, annotator=annotator)
+    sentences = []
+    for template in templates:
+        for sentence in extractor.tokenize(template.replace('@', '')):
+            try:
+                sentences.append(extractor.parse(sentence))
+            except:
+                pass
+    extractor.close()
+    print('Templates: {0} \t Parse trees: {1}'.format(len(templates), len(sentences)))
+
+    legacy_time, legacy_groups = measure(LegacyTree, sentences)
+    time_, groups = measure(Tree, sentences)
+    if groups != legacy_groups:
+        print('Different verb groups')
+
+    nqueries = sum([len(group) for group in groups if group is not None])
+    print('Verb pairs: {0} \t Unreadable trees: {1}'.format(nqueries, groups.count(None)))
+    print('legacy \t Time: {0}s'.format(round(legacy_time, 3)))
+    print('indexed \t Time: {0}s'.format(round(time_, 3)))
+    print('Speedup: {0}x'.format(round(legacy_time / time_, 1)))
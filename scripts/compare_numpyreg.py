@@ -0,0 +1,106 @@
+"""
+Description:
+    Comparison of the numpy inference engine of NeuralREG (reg/numpyreg.py) against the DyNet model, both with
+    the inference configuration of reg/generate.py (no dropout): startup time (import and loading of the model),
+    outputs of the greedy and of the beam searches on the instances of the development set (one by one, in
+    batches and by entry, as reg/generate.py decodes them), which are checked to be the same token for token,
+    and latency per mention of the searches.
+
+    ARGS:
+        [1] Path to the trained model (.dy)
+        [2] Path to the same model exported by scripts/export_reg.py (.npz)
+        [3] Optional path to the REG data (folder with vocab.json and dev.json, evaluation/data/reg by default)
+        [4] Optional number of instances of the development set (all of them by default)
+
+    EXAMPLE:
+        python3 scripts/compare_numpyreg.py reg/model1.dy reg/model1.npz evaluation/data/reg 500
+"""
+
+import sys
+sys.path.append('./')
+sys.path.append('../')
+sys.path.append('./reg')
+sys.path.append('../reg')
+
+import json
+import os
+import time
+
+from generate import CONFIG
+
+
+def load_dynet(model_path, path, config):
+    start = time.perf_counter()
+    from neuralreg import NeuralREG
+    model = NeuralREG(path=path, config=config)
+    model.populate(model_path)
+    return model, time.perf_counter() - start
+
+
+def load_numpy(weights_path, path, config):
+    start = time.perf_counter()
+    from numpyreg import NumpyREG
+    model = NumpyREG(path=path, config=config, weights_path=weights_path)
+    return model, time.perf_counter() - start
+
+
+def run(search, queries):
+    outputs, latency = [], []
+    for pre_context, pos_context, entity in queries:
+        start = time.perf_counter()
+        outputs.append(search(pre_context, pos_context, entity))
+        latency.append(time.perf_counter() - start)
+    return outputs, latency
+
+
+def report(name, dynet_outputs, dynet_latency, numpy_outputs, numpy_latency):
+    same = sum([x == y for x, y in zip(dynet_outputs, numpy_outputs)])
+    dynet_time, numpy_time = sum(dynet_latency) / len(dynet_latency), sum(numpy_latency) / len(numpy_latency)
+    print('{0} \t Same outputs: {1}/{2} \t DyNet: {3}ms \t NumPy: {4}ms \t Speedup: {5}x (per mention)'.format(
+        name, same, len(dynet_outputs), round(dynet_time * 1000, 3), round(numpy_time * 1000, 3), round(dynet_time / numpy_time, 2)))
+
+
+if __name__ == '__main__':
+    model_path = sys.argv[1]
+    weights_path = sys.argv[2]
+    path = sys.argv[3] if len(sys.argv) > 3 else os.path.abspath('evaluation/data/reg')
+    size = int(sys.argv[4]) if len(sys.argv) > 4 else None
+
+    # the configuration of the pipeline, so that the comparison holds for the neuralreg and numpyreg flags
+    config = CONFIG
+
+    numpy_model, numpy_startup = load_numpy(weights_path, path, config)
+    dynet_model, dynet_startup = load_dynet(model_path, path, config)
+    print('Startup \t DyNet: {0}s \t NumPy: {1}s'.format(round(dynet_startup, 2), round(numpy_startup, 2)))
+
+    with open(os.path.join(path, 'dev.json'), encoding='utf-8') as f:
+        devset = json.load(f)[:size]
+    queries = [([dynet_model.EOS] + inst['pre_context'], inst['pos_context'] + [dynet_model.EOS], inst['entity']) for inst in devset]
+
+    beam = config['BEAM_SIZE']
+    dynet_outputs, dynet_latency = run(dynet_model.generate, queries)
+    numpy_outputs, numpy_latency = run(numpy_model.generate, queries)
+    report('Greedy', dynet_outputs, dynet_latency, numpy_outputs, numpy_latency)
+
+    dynet_outputs, dynet_latency = run(lambda *query: dynet_model.beam_search(*query, beam), queries)
+    numpy_outputs, numpy_latency = run(lambda *query: numpy_model.beam_search(*query, beam), queries)
+    report('Beam', [x[0] for x in dynet_outputs], dynet_latency, [x[0] for x in numpy_outputs], numpy_latency)
+
+    # all the queries at once, in batches of DECODE_BATCH
+    start = time.perf_counter()
+    dynet_outputs = dynet_model.batch_beam_search(queries, beam)
+    dynet_latency = len(queries) * [(time.perf_counter() - start) / len(queries)]
+    start = time.perf_counter()
+    numpy_outputs = numpy_model.batch_beam_search(queries, beam)
+    numpy_latency = len(queries) * [(time.perf_counter() - start) / len(queries)]
+    report('Batched beam', [x[0] for x in dynet_outputs], dynet_latency, [x[0] for x in numpy_outputs], numpy_latency)
+
+    # decoding of reg/generate.py: the instances as entries (context between eos symbols) with a single mention
+    entries = [(pre_context + [entity] + pos_context, [len(pre_context)]) for pre_context, pos_context, entity in queries]
+    start = time.perf_counter()
+    dynet_outputs = dynet_model.realize_entries(entries, beam)
+    dynet_latency = len(queries) * [(time.perf_counter() - start) / len(queries)]
+    start = time.perf_counter()
+    numpy_outputs = numpy_model.realize_entries(entries, beam)
+    numpy_latency = len(queries) * [(time.perf_counter() - start) / len(queries)]
+    report('Entries', [x[0][0] for x in dynet_outputs], dynet_latency, [x[0][0] for x in numpy_outputs], numpy_latency)
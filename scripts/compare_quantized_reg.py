@@ -0,0 +1,69 @@
+"""
+Description:
+    Comparison of the quantized weights of the numpy inference engine of NeuralREG (reg/numpyreg.py) against its
+    float32 weights on the development set: memory of the quantized weights (embedding tables and softmax
+    projection of the decoder), peak resident memory of the process (loading and decoding, including the
+    temporary dequantized blocks), accuracy of the best refexes against the references, refexes which are the
+    same as the ones of the float32 model and decoding time (batched beam search, as in reg/generate.py). Each
+    weight format is run in its own process, so that the peak memory is its own.
+
+    ARGS:
+        [1] Path to the model exported by scripts/export_reg.py (.npz)
+        [2] Optional path to the REG data (folder with vocab.json and dev.json, evaluation/data/reg by default)
+        [3] Optional number of instances of the development set (all of them by default)
+
+    EXAMPLE:
+        python3 scripts/compare_quantized_reg.py reg/model1.npz evaluation/data/reg 500
+"""
+
+import sys
+sys.path.append('./')
+sys.path.append('../')
+sys.path.append('./reg')
+sys.path.append('../reg')
+
+import json
+import multiprocessing
+import os
+import resource
+import time
+
+from generate import CONFIG
+from numpyreg import NumpyREG, QUANTIZATIONS
+
+
+def decode(job):
+    weights_path, path, quantization, queries = job
+    config = dict(CONFIG)
+    config['QUANTIZATION'] = quantization
+    model = NumpyREG(path=path, config=config, weights_path=weights_path)
+
+    start = time.perf_counter()
+    outputs = model.batch_beam_search(queries, model.config.beam)
+    refexes = [' '.join(candidates[0]).replace('eos', '').strip() for candidates in outputs]
+    duration = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    return refexes, duration, model.nbytes(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+if __name__ == '__main__':
+    weights_path = sys.argv[1]
+    path = sys.argv[2] if len(sys.argv) > 2 else os.path.abspath('evaluation/data/reg')
+    size = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    with open(os.path.join(path, 'dev.json'), encoding='utf-8') as f:
+        devset = json.load(f)[:size]
+    queries = [(['eos'] + inst['pre_context'], inst['pos_context'] + ['eos'], inst['entity']) for inst in devset]
+    references = [' '.join(inst['refex']).replace('eos', '').strip() for inst in devset]
+
+    float_refexes = None
+    for quantization in [None] + QUANTIZATIONS:
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            refexes, duration, nbytes, peak = pool.apply(decode, [(weights_path, path, quantization, queries)])
+        if float_refexes is None:
+            float_refexes = refexes
+
+        accuracy = sum([refex == reference for refex, reference in zip(refexes, references)]) / len(references)
+        same = sum([refex == float_refex for refex, float_refex in zip(refexes, float_refexes)])
+        print('{0} \t Weights: {1}MB \t Peak RSS: {2}MB \t Accuracy: {3} \t Same as float32: {4}/{5} \t Time: {6}s'.format(
+            quantization or 'float32', round(nbytes / 2**20, 2), round(peak / 2**20, 2), round(accuracy, 4), same, len(refexes), round(duration, 2)))
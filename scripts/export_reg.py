@@ -0,0 +1,35 @@
+"""
+Description:
+    Export a trained NeuralREG model (DyNet) to a numpy .npz file, which is run by the numpy inference engine
+    (reg/numpyreg.py, model flag numpyreg of reg/generate.py). The model is built with the configuration of
+    reg/generate.py.
+
+    ARGS:
+        [1] Path to the trained model (.dy)
+        [2] Path to the .npz file where the model will be saved
+        [3] Optional path to the REG data (folder with vocab.json, evaluation/data/reg by default)
+
+    EXAMPLE:
+        python3 scripts/export_reg.py reg/model1.dy reg/model1.npz
+"""
+
+import sys
+sys.path.append('./')
+sys.path.append('../')
+sys.path.append('./reg')
+sys.path.append('../reg')
+
+import os
+
+from generate import CONFIG
+from neuralreg import NeuralREG
+
+
+if __name__ == '__main__':
+    model_path = sys.argv[1]
+    out_path = sys.argv[2]
+    path = sys.argv[3] if len(sys.argv) > 3 else os.path.abspath('evaluation/data/reg')
+
+    neuralreg = NeuralREG(path=path, config=CONFIG)
+    neuralreg.populate(model_path)
+    neuralreg.export(out_path)
@@ -10,8 +10,12 @@ Description:
         [1] Path to the folder where WebNLG corpus is available (versions/v1.4/en)
         [2] Path to the folder where the data will be saved (Folder will be created in case it does not exist)
 
+    ENVIRONMENT:
+        DEEPNLG_WORKERS: optional number of processes parsing the corpus files (1 by default)
+
     EXAMPLE:
         python3 preprocess.py ../versions/v1.4/en structing/
+        DEEPNLG_WORKERS=8 python3 preprocess.py ../versions/v1.4/en structing/
 """
 
 import sys
@@ -42,7 +46,7 @@ class Structing(Preprocess):
     def load(self, path):
         flat = lambda struct: [w for w in struct if w not in ['<SNT>', '</SNT>']]
 
-        entryset = parsing.run_parser(path)
+        entryset = parsing.iter_cached_parser(path)
 
         data, size = [], 0
         invocab, outvocab = [], []
@@ -96,7 +100,7 @@ class Structing(Preprocess):
     def load_simple(self, path):
         flat = lambda struct: [w for w in struct if w not in ['<SNT>', '</SNT>']]
 
-        entryset = parsing.run_parser(path)
+        entryset = parsing.iter_cached_parser(path)
 
         data, size = [], 0
         invocab, outvocab = [], []